@@ -1,8 +1,19 @@
+import asyncio
+import blocking
 import logging
+import metrics
 import os
+import profiling
+import refresh
+import threading
+import transport
+import user_store
 
 from argparse import ArgumentParser
-from constitutionbot import app_handler
+from config import get_config
+from constitutionbot import (app_handler, count_send_error, inline_query_cmd, prewarm,
+                             refresh_sources)
+from corpus import get_corpus
 from telegram import Update
 from telegram.ext import (
     filters,
@@ -10,9 +21,13 @@ from telegram.ext import (
     CallbackContext,
     CommandHandler,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
 )
 from typing import List, Optional, Set
+from transport import TimedRequest
+from update_scheduler import UPDATE_CONCURRENCY, ChatOrderedProcessor
+from webhook import WEBHOOK_LISTEN, WEBHOOK_PORT, WebhookServer, run_webhook
 
 
 def main() -> None:
@@ -36,6 +51,62 @@ def main() -> None:
     login.add_argument(
         '--user', action='store', dest='ig_user', metavar='Instagram User',
         type=str, help='Username through which Instaloader is ran')
+    parser.add_argument(
+        '--pool-size', action='store', type=int, dest='pool_size', metavar='THREADS',
+        help='Threads available for blocking passage fetches (default: 8)')
+    parser.add_argument(
+        '--fetch-timeout', action='store', type=float, dest='fetch_timeout', metavar='SECONDS',
+        help='Seconds a handler waits on a blocking fetch before giving up (default: 15)')
+    parser.add_argument(
+        '--max-connections', action='store', type=int, dest='max_connections', metavar='N',
+        help='Size of the pooled connection set to the Bot API (default: 20)')
+    parser.add_argument(
+        '--webhook', action='store_true',
+        help='Receive updates on a local HTTP endpoint instead of long polling')
+    parser.add_argument(
+        '--webhook-url', action='store', dest='webhook_url', metavar='URL',
+        help='Public URL to register with Telegram for --webhook (default: leave as is)')
+    parser.add_argument(
+        '--listen', action='store', default=WEBHOOK_LISTEN, metavar='HOST',
+        help='Address the webhook listens on (default: {})'.format(WEBHOOK_LISTEN))
+    parser.add_argument(
+        '--port', action='store', type=int, default=WEBHOOK_PORT,
+        help='Port the webhook listens on (default: {})'.format(WEBHOOK_PORT))
+    parser.add_argument(
+        '--concurrency', action='store', type=int, default=UPDATE_CONCURRENCY, metavar='N',
+        help='Updates from different chats handled at once (default: {})'.format(
+            UPDATE_CONCURRENCY))
+    parser.add_argument(
+        '--metrics-port', action='store', type=int, default=metrics.METRICS_PORT,
+        dest='metrics_port', metavar='PORT',
+        help='Serve Prometheus metrics on this port at /metrics (default: off)')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Profile a sample of handler runs with cProfile, written to --profile-dir')
+    parser.add_argument(
+        '--profile-rate', action='store', type=float, default=profiling.PROFILE_RATE,
+        dest='profile_rate', metavar='FRACTION',
+        help='Share of updates to profile (default: {})'.format(profiling.PROFILE_RATE))
+    parser.add_argument(
+        '--profile-dir', action='store', default=profiling.PROFILE_DIR, dest='profile_dir',
+        metavar='DIR', help='Where profiles are written (default: {})'.format(
+            profiling.PROFILE_DIR))
+    parser.add_argument(
+        '--profile-slowest', action='store', type=int, default=profiling.PROFILE_SLOWEST,
+        dest='profile_slowest', metavar='N',
+        help='Keep a stack breakdown of the N slowest profiled updates (default: {})'.format(
+            profiling.PROFILE_SLOWEST))
+    parser.add_argument(
+        '--profile-memory', action='store_true', dest='profile_memory',
+        help='Also trace allocations with tracemalloc while profiling')
+    parser.add_argument(
+        '--prewarm', action='store_true',
+        help='Build the passage, search and inline indexes in the background at startup')
+    parser.add_argument(
+        '--refresh-interval', action='store', type=float, default=refresh.REFRESH_INTERVAL,
+        dest='refresh_interval', metavar='SECONDS',
+        help='Re-fetch the WikiSource pages in the background this often, 0 to turn off '
+             '(default: {:.0f})'.format(refresh.REFRESH_INTERVAL))
     parser.add_argument('--log-file', action='store_true', dest='logfile', help='Log to file')
     parser.add_argument('-d', '--debug', action='store_true', help='Enable Debug mode')
 
@@ -61,16 +132,99 @@ def main() -> None:
         user_whitelist = set(args.whitelist)
         logging.info('Authorized users: %s', user_whitelist)
 
-    token = os.environ['TG_TOKEN']
-    application = Application.builder().token(token).build()
+    if 'TG_TOKEN' not in os.environ:
+        os.environ['TG_TOKEN'] = args.token
+    # read once here so missing settings fail at startup rather than on the first update
+    config = get_config()
+
+    blocking.configure(args.pool_size, args.fetch_timeout)
+    transport.configure(args.max_connections)
+
+    # mmap the compiled corpus up front so the first lookup needs no network
+    get_corpus()
+
+    commands = [command for handler in app_handler for command in handler.commands]
+    profiler = None
+    if args.profile:
+        profiler = profiling.HandlerProfiler(args.profile_dir, args.profile_rate,
+                                             args.profile_slowest, args.profile_memory)
+        logging.info('Profiling {:.0%} of updates into {}'.format(args.profile_rate,
+                                                                args.profile_dir))
+    processor = ChatOrderedProcessor(args.concurrency, commands + ['start'], profiler)
+    # updates for different chats run in parallel; each chat's updates stay in order
+    builder = (
+        Application.builder()
+        .token(config.token)
+        .base_url(transport.TELEGRAM_API_URL + '/bot')
+        .base_file_url(transport.TELEGRAM_API_URL + '/file/bot')
+        .concurrent_updates(processor)
+        .request(TimedRequest(connection_pool_size=args.concurrency,
+                              on_error=count_send_error))
+        .post_shutdown(shutdown)
+    )
+    if args.prewarm and not args.webhook:
+        builder.post_init(prewarm_once_polling)
+    application = builder.build()
 
     application.add_handlers(app_handler)
     application.add_handler(CommandHandler('start', start))
     application.add_handler(MessageHandler(filters.COMMAND, unknown))
-    # application.add_handler(InlineQueryHandler(app_handler.inline_query))
+    application.add_handler(InlineQueryHandler(inline_query_cmd))
     # application.add_error_handler(error_handler.error_handler)
 
-    application.run_polling()
+    if args.metrics_port:
+        metrics.callback('constitutionbot_updates_in_flight', 'Updates waiting or being handled',
+                         'gauge', lambda: {('queued',): processor.queued,
+                                           ('running',): processor.running}, ('state',))
+        metrics.callback('constitutionbot_chat_queue_depth_max', 'Most updates queued for one '
+                         'chat', 'gauge', lambda: processor.stats()['max_chat_depth'])
+        metrics.callback('constitutionbot_update_wait_p99_seconds', 'p99 wait before a recent '
+                         'update started', 'gauge', lambda: processor.stats()['wait_p99'])
+        metrics.start_server(args.metrics_port)
+
+    if args.refresh_interval > 0:
+        refresher = refresh.Refresher(refresh_sources, args.refresh_interval).start()
+        metrics.callback('constitutionbot_refreshes_total', 'Background source refreshes, by '
+                         'outcome', 'counter', lambda: {
+                             ('ok',): refresher.runs - refresher.failures,
+                             ('failed',): refresher.failures}, ('outcome',))
+        metrics.callback('constitutionbot_refresh_last_success_timestamp_seconds', 'When a '
+                         'refresh last reached WikiSource', 'gauge',
+                         lambda: refresher.last_success or 0)
+
+    if args.webhook:
+        server = WebhookServer(application, args.listen, args.port)
+        try:
+            asyncio.run(run_webhook(application, server, args.webhook_url, shutdown,
+                                    start_prewarm if args.prewarm else None))
+        except KeyboardInterrupt:
+            pass
+    else:
+        application.run_polling()
+
+
+def start_prewarm() -> None:
+    # once the bot is taking updates, so it doesn't compete with startup; it runs alongside
+    # the first updates instead of delaying them
+    threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+
+
+async def prewarm_once_polling(application: Application) -> None:
+    # post_init runs before polling starts, so wait until the application is running
+    async def wait_and_prewarm() -> None:
+        while not application.running:
+            await asyncio.sleep(0.1)
+        start_prewarm()
+    asyncio.get_running_loop().create_task(wait_and_prewarm())
+
+
+async def shutdown(application: Application) -> None:
+    await transport.close()
+    profiler = application.update_processor.profiler
+    if profiler is not None:
+        profiler.dump()
+    # write out any buffered profile updates before exiting
+    user_store.close_store()
 
 
 async def start(update: Update, context: CallbackContext) -> None:
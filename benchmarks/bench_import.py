@@ -0,0 +1,113 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+from datetime import datetime
+
+DEFAULT_MODULES = ['constitutionbot', 'app']
+# should only be imported once they're needed, see source_cache, passage_index and metrics
+LAZY_MODULES = ['requests', 'bs4', 'http.server']
+SETTINGS = {'TG_TOKEN': 'TOKEN', 'ADMIN_ID': '1', 'BOT_ID': '2', 'WHITELIST_IDS': '1'}
+
+
+def import_times(module, settings=False):
+    # one fresh interpreter per run; returns {module: (self us, cumulative us)}
+    env = dict((name, value) for name, value in os.environ.items() if name not in SETTINGS)
+    if settings:
+        env.update(SETTINGS)  # older revisions read these at import
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if name == 'site':
+            times = {}  # everything so far was interpreter startup
+            continue
+        times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def measure(module, runs, top, settings=False):
+    totals = []
+    heaviest = {}
+    eager = set()
+    for _ in range(runs):
+        times = import_times(module, settings)
+        eager.update(name for name in LAZY_MODULES if name in times)
+        totals.append(times[module][1])
+        for name, (_, cumulative) in times.items():
+            if name != module and '.' not in name:
+                heaviest.setdefault(name, []).append(cumulative)
+    ranked = sorted(((statistics.median(samples), name) for name, samples in heaviest.items()),
+                    reverse=True)
+    return {'module': module, 'runs': runs,
+            'median_ms': statistics.median(totals) / 1000, 'min_ms': min(totals) / 1000,
+            'heaviest': [{'name': name, 'median_ms': us / 1000} for us, name in ranked[:top]],
+            'eager': sorted(eager)}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    previous = {result['module']: result for result in (baseline or {}).get('results', [])}
+    for result in results:
+        line = '{:<18} median {:7.1f} ms  min {:7.1f} ms'.format(
+            result['module'], result['median_ms'], result['min_ms'])
+        old = previous.get(result['module'])
+        if old is not None and old['median_ms']:
+            line += '  {:+.1f}%'.format((result['median_ms'] / old['median_ms'] - 1) * 100)
+        print(line)
+        for heavy in result['heaviest']:
+            print('    {:<28} {:7.1f} ms'.format(heavy['name'], heavy['median_ms']))
+        if result['eager']:
+            print('    imported eagerly: ' + ', '.join(result['eager']))
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Measures cold import time of the bot\'s modules with '
+                                        '-X importtime, without any bot settings in the '
+                                        'environment')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='Modules to import (default: {})'.format(' '.join(DEFAULT_MODULES)))
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Fresh interpreters per module')
+    parser.add_argument('--top', type=int, default=8, help='Heaviest top-level imports to list')
+    parser.add_argument('--settings', action='store_true',
+                        help='Set placeholder TG_TOKEN, ADMIN_ID, BOT_ID and WHITELIST_IDS, '
+                             'for revisions that need them to import')
+    parser.add_argument('-o', '--output', help='Write the results as JSON')
+    parser.add_argument('--compare', metavar='JSON_FILE',
+                        help='Earlier results to compare median import time against')
+    args = parser.parse_args()
+
+    results = [measure(module, args.runs, args.top, args.settings) for module in args.modules]
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump({'revision': git_revision(), 'python': platform.python_version(),
+                       'created': datetime.now().isoformat(timespec='seconds'),
+                       'results': results}, f, indent=2)
+        print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import asyncio
+import httpx
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from datetime import datetime
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# everything below runs offline: sources come from the fixtures, users from a scratch database
+_scratch = tempfile.mkdtemp(prefix='bench_pipeline_')
+os.environ['SOURCE_CACHE_DIR'] = os.path.join(_scratch, 'source_cache')
+os.environ['CORPUS_PATH'] = os.path.join(_scratch, 'constitution.corpus')
+os.environ['USER_DB_PATH'] = os.path.join(_scratch, 'users.db')
+
+import constitutionbot  # noqa: E402
+import corpus  # noqa: E402
+import passage_index  # noqa: E402
+
+from benchmarks.fake_bot_api import make_update  # noqa: E402
+from config import Config, set_config  # noqa: E402
+from references import InvalidReference, ReferenceParser, parse_references  # noqa: E402
+from search_index import passage_body  # noqa: E402
+from send_queue import OutboundQueue  # noqa: E402
+from source_cache import default_cache  # noqa: E402
+from telegram import Update  # noqa: E402
+
+RESPONSES = [
+    {'ok': True, 'result': {'message_id': 1}},
+    {'ok': False, 'description': constitutionbot.RECOGNIZED_ERROR_PARSE + ' entities'},
+    {'ok': False, 'description': 'Forbidden: bot was blocked by the user'},
+    {'ok': False, 'description': constitutionbot.RECOGNIZED_ERROR_MIGRATE,
+     'parameters': {'migrate_to_chat_id': -1002}},
+    {'ok': False, 'description': 'Bad Request: something new'},
+]
+COMMANDS = ['/get 1:8', '/get 2:1', '/get 6', '/getAmd 1', '/getAmd 10']
+
+
+class RecordingApi:
+    # answers the outbound queue's sendMessage calls without a network
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, data):
+        self.sent += 1
+        return httpx.Response(200, json={'ok': True, 'result': {'message_id': self.sent}})
+
+
+def summarize(name, samples):
+    total = sum(samples)
+    samples = sorted(samples)
+    return {'name': name, 'iterations': len(samples),
+            'ops_per_sec': len(samples) / total if total else 0.0,
+            'mean_us': total / len(samples) * 1e6,
+            'p50_us': samples[len(samples) // 2] * 1e6,
+            'p99_us': samples[max(int(len(samples) * 0.99) - 1, 0)] * 1e6}
+
+
+def bench(name, func, iterations, setup=None):
+    samples = []
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(i)
+        samples.append(time.perf_counter() - start)
+    return summarize(name, samples)
+
+
+async def bench_async(name, func, iterations):
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await func(i)
+        samples.append(time.perf_counter() - start)
+    return summarize(name, samples)
+
+
+def load_fixtures(constitution_path, amendments_path):
+    with open(constitution_path, encoding='utf8') as f:
+        constitution = f.read()
+    with open(amendments_path, encoding='utf8') as f:
+        amendments = f.read()
+    default_cache.seed(corpus.CONSTITUTION_URL, constitution)
+    default_cache.seed(corpus.AMENDMENTS_URL, amendments)
+    return constitution, amendments
+
+
+def run(iterations, constitution, amendments):
+    results = []
+    references = ['1:{}'.format(section) for section in range(1, 11)]
+
+    def get(i):
+        constitutionbot.get_passage(references[i % len(references)])
+
+    # without a corpus every lookup goes through the source cache and the parsed index
+    corpus.load_corpus(os.environ['CORPUS_PATH'])
+    results.append(bench('get_passage cold', get, max(iterations // 20, 10),
+                         setup=passage_index.clear_indexes))
+    results.append(bench('get_passage warm', get, iterations))
+
+    data, passages = corpus.build_corpus(constitution, amendments)
+    with open(os.environ['CORPUS_PATH'], 'wb') as f:
+        f.write(data)
+    corpus.load_corpus(os.environ['CORPUS_PATH'])
+    results.append(bench('get_passage corpus', get, iterations))
+
+    parser = ReferenceParser()
+
+    def reject(i):
+        try:
+            parser.parse('9:9')
+        except InvalidReference:
+            pass
+    results.append(bench('parse_references', lambda i: parse_references('1:8-1:10,2:1'),
+                         iterations))
+    results.append(bench('reject reference cached', reject, iterations))
+
+    batch = parse_references('1:8-1:10,2:1')
+    results.append(bench('batch lookup corpus', lambda i: constitutionbot.pack_messages(
+        constitutionbot.get_passages(batch)), iterations))
+
+    raw = [passage_body(passage) for passage in passages.values()]
+    results.append(bench('strip_markdown', lambda i: passage_index.strip_markdown(
+        raw[i % len(raw)]), iterations))
+
+    short = passages[(passage_index.ARTICLE, 1, 1)]
+    long = passages[(passage_index.ARTICLE, 1, 8)]  # over 4096 characters
+    results.append(bench('build_message', lambda i: [json.dumps(build) for build in
+                   constitutionbot.build_message('1', short, 'passage')], iterations))
+    results.append(bench('build_message chunked', lambda i: [json.dumps(build) for build in
+                   constitutionbot.build_message('1', long, 'passage')], iterations))
+
+    def classify(i):
+        user = constitutionbot.User(1000 + i, 'user', 'First', 'Last')
+        constitutionbot.handle_response(RESPONSES[i % len(RESPONSES)], user, user.get_uid(),
+                                        'passage')
+    results.append(bench('handle_response', classify, iterations))
+
+    # no global send limit and one chat per update, so the send limits don't set the pace
+    constitutionbot.outbound_queue = OutboundQueue(RecordingApi().send, rate=1e9,
+                                                   bucket_size=10 ** 9)
+    updates = [Update.de_json(make_update(i + 1, 1000 + i, COMMANDS[i % len(COMMANDS)], 1), None)
+               for i in range(iterations)]
+    results.append(asyncio.run(bench_async(
+        'main_cmd dispatch', lambda i: constitutionbot.main_cmd(updates[i], None),
+        iterations)))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    previous = {result['name']: result for result in (baseline or {}).get('results', [])}
+    for result in results:
+        line = '{:<24} {:12.1f} ops/s  p50 {:9.1f} us  p99 {:9.1f} us'.format(
+            result['name'], result['ops_per_sec'], result['p50_us'], result['p99_us'])
+        old = previous.get(result['name'])
+        if old is not None and old['p50_us']:
+            line += '  p50 {:+.1f}%'.format((result['p50_us'] / old['p50_us'] - 1) * 100)
+        print(line)
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Benchmarks the passage pipeline offline against saved '
+                                        'WikiSource pages')
+    parser.add_argument('-n', '--iterations', type=int, default=2000, help='Runs per case')
+    parser.add_argument('--constitution', default=os.path.join(FIXTURES_DIR, 'constitution.html'),
+                        metavar='HTML_FILE', help='Saved constitution page')
+    parser.add_argument('--amendments', default=os.path.join(FIXTURES_DIR, 'bill_of_rights.html'),
+                        metavar='HTML_FILE', help='Saved Bill of Rights page')
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help='Where to write the JSON results')
+    parser.add_argument('--compare', metavar='JSON_FILE',
+                        help='Earlier results to compare p50 latency against')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    set_config(Config('TOKEN', '1', '2', [1]))
+    constitution, amendments = load_fixtures(args.constitution, args.amendments)
+    results = run(args.iterations, constitution, amendments)
+    constitutionbot.get_store().close()
+    shutil.rmtree(_scratch, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump({'revision': git_revision(), 'python': platform.python_version(),
+                   'created': datetime.now().isoformat(timespec='seconds'),
+                   'iterations': args.iterations, 'results': results}, f, indent=2)
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import transport
+
+RESPONSE = json.dumps({'ok': True, 'result': {'message_id': 1}}).encode('utf8')
+MESSAGE = json.dumps({'chat_id': 1, 'text': 'Congress shall make no law'})
+
+
+class SendMessageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def summarize(name, samples):
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2] * 1000
+    p99 = samples[int(len(samples) * 0.99) - 1] * 1000
+    print('{:<24} mean {:7.3f} ms  p50 {:7.3f} ms  p99 {:7.3f} ms'.format(
+        name, statistics.mean(samples) * 1000, p50, p99))
+
+
+def bench_unpooled(url, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        requests.post(url, MESSAGE, headers=transport.JSON_HEADER, timeout=10)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def bench_pooled(url, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        await transport.post(url, MESSAGE)
+        samples.append(time.perf_counter() - start)
+    await transport.close()
+    return samples
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Compares per-message latency of unpooled requests.post '
+                                        'and the pooled transport against a local fake Bot API')
+    parser.add_argument('-n', '--count', type=int, default=500, help='Messages per run')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SendMessageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/botTOKEN/sendMessage'.format(server.server_port)
+
+    summarize('requests.post (no pool)', bench_unpooled(url, args.count))
+    summarize('transport.post (pooled)', asyncio.run(bench_pooled(url, args.count)))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
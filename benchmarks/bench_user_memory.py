@@ -0,0 +1,64 @@
+import gc
+import tracemalloc
+import uuid
+
+from argparse import ArgumentParser
+from datetime import datetime
+from constitutionbot import User
+
+
+class LegacyUser:
+    # the User layout before it was slotted: uuid key, datetimes and a per-instance __dict__
+    def __init__(self, uid, uname, f_name='', l_name=''):
+        self.uid = uuid.UUID(int=uid % 2 ** 128)
+        self.username = uname
+        self.first_name = f_name
+        self.last_name = l_name
+        self.created = datetime.today()
+        self.last_received = datetime.today()
+        self.last_sent = datetime.today()
+        self.reply_to = ''
+        self.promo = False
+
+
+def row(i):
+    uid = -1000000000000 - i if i % 10 == 0 else 100000000 + i
+    return (uid, 'user{}'.format(i), 'First{}'.format(i), 'Last{}'.format(i), 1700000000 + i,
+            1700000000 + i, 1700000000 + i, '', 0)
+
+
+def measure(build, count):
+    gc.collect()
+    tracemalloc.start()
+    users = build(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    gc.collect()
+    return current / count
+
+
+def build_rows(count):
+    return [row(i) for i in range(count)]
+
+
+def build_legacy(count):
+    return [LegacyUser(r[0], r[1], r[2], r[3]) for r in map(row, range(count))]
+
+
+def build_slotted(count):
+    return [User.from_row(r) for r in map(row, range(count))]
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Reports bytes per user for large in-memory user batches')
+    parser.add_argument('-n', '--count', type=int, default=1000000, help='Users to build')
+    args = parser.parse_args()
+
+    for name, build in (('store rows (tuples)', build_rows), ('legacy User', build_legacy),
+                        ('slotted User', build_slotted)):
+        print('{:<24} {:7.1f} bytes/user'.format(name, measure(build, args.count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import asyncio
+import http.client
+import json
+import multiprocessing
+import threading
+import time
+
+from argparse import ArgumentParser
+from collections import defaultdict
+
+from benchmarks.fake_bot_api import make_update, start_process
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
+from update_scheduler import ChatOrderedProcessor
+from webhook import WebhookServer
+
+
+class Recorder:
+    # stands in for a /get handler: waits on a simulated fetch, then replies
+    def __init__(self, count, delay):
+        self.count = count
+        self.delay = delay
+        self.seen = defaultdict(list)
+        self.handled = 0
+        self.done = asyncio.Event()
+
+    async def handle(self, update: Update, context) -> None:
+        await asyncio.sleep(self.delay)
+        await context.bot.send_message(update.effective_chat.id, 'ok')
+        self.seen[update.effective_chat.id].append(update.update_id)
+        self.handled += 1
+        if self.handled == self.count:
+            self.done.set()
+
+    def in_order(self):
+        return all(ids == sorted(ids) for ids in self.seen.values())
+
+
+def build_updates(count, chats):
+    return [make_update(i + 1, 1000 + i % chats, '/get 1:8') for i in range(count)]
+
+
+def build_application(base_url, recorder, concurrency=None):
+    builder = Application.builder().token('TOKEN').base_url(base_url)
+    if concurrency:
+        builder.concurrent_updates(ChatOrderedProcessor(concurrency))
+        builder.connection_pool_size(concurrency)
+    application = builder.build()
+    application.add_handler(MessageHandler(filters.ALL, recorder.handle))
+    return application
+
+
+def post_updates(port, updates, connections, secret):
+    # like Telegram: parallel connections, each chat's updates delivered one after another
+    shards = defaultdict(list)
+    for update in updates:
+        shards[update['message']['chat']['id'] % connections].append(update)
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+
+    def deliver(shard):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        for update in shard:
+            connection.request('POST', '/telegram', json.dumps(update), headers)
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200, response.status
+
+    threads = [threading.Thread(target=deliver, args=(shard,)) for shard in shards.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+async def bench_polling(updates, delay, concurrency):
+    process, base_url = start_process(updates)
+    recorder = Recorder(len(updates), delay)
+    application = build_application(base_url, recorder, concurrency)
+    async with application:
+        await application.start()
+        start = time.perf_counter()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await recorder.done.wait()
+        elapsed = time.perf_counter() - start
+        await application.updater.stop()
+        await application.stop()
+    process.terminate()
+    return elapsed, recorder.in_order()
+
+
+async def bench_webhook(updates, delay, concurrency, connections):
+    process, base_url = start_process()
+    recorder = Recorder(len(updates), delay)
+    application = build_application(base_url, recorder, concurrency)
+    async with application:
+        await application.start()
+        server = WebhookServer(application, '127.0.0.1', 0, '/telegram', secret='secret')
+        await server.start()
+
+        stand_in = multiprocessing.Process(target=post_updates,
+                                           args=(server.port, updates, connections, 'secret'))
+        start = time.perf_counter()
+        stand_in.start()
+        await recorder.done.wait()
+        elapsed = time.perf_counter() - start
+        stand_in.join()
+
+        await server.stop()
+        await application.stop()
+    process.terminate()
+    return elapsed, recorder.in_order()
+
+
+def report(name, count, elapsed, in_order):
+    print('{:<10} {:6d} updates in {:6.2f}s  {:8.1f} updates/s  per-chat order {}'.format(
+        name, count, elapsed, count / elapsed, 'kept' if in_order else 'BROKEN'))
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Compares update throughput of sequential polling, '
+                                        'concurrent polling and the webhook server against a '
+                                        'local fake Bot API')
+    parser.add_argument('-n', '--count', type=int, default=500, help='Updates to deliver')
+    parser.add_argument('--chats', type=int, default=50, help='Distinct chats')
+    parser.add_argument('--delay', type=float, default=0.02,
+                        help='Seconds each handler waits, standing in for a passage fetch')
+    parser.add_argument('--concurrency', type=int, default=16, help='Updates handled at once')
+    parser.add_argument('--connections', type=int, default=40,
+                        help='Parallel connections the stand-in POSTs on')
+    args = parser.parse_args()
+
+    updates = build_updates(args.count, args.chats)
+    report('sequential', args.count, *asyncio.run(bench_polling(updates, args.delay, None)))
+    report('polling', args.count, *asyncio.run(
+        bench_polling(updates, args.delay, args.concurrency)))
+    report('webhook', args.count, *asyncio.run(
+        bench_webhook(updates, args.delay, args.concurrency, args.connections)))
+
+
+if __name__ == '__main__':
+    main()
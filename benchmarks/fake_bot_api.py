@@ -0,0 +1,243 @@
+import json
+import multiprocessing
+import queue
+import random
+import threading
+import time
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USER = {'id': 2, 'is_bot': True, 'first_name': 'Constitution Bot',
+            'username': 'constitution_bot'}
+REPLY_METHODS = ('sendMessage', 'answerInlineQuery')
+
+
+def make_update(update_id, chat_id, text, user_id=None, chat_type='private'):
+    user_id = chat_id if user_id is None else user_id
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'User{}'.format(user_id)}
+    chat = {'id': chat_id, 'type': chat_type}
+    if chat_type == 'private':
+        chat['first_name'] = user['first_name']
+    else:
+        chat['title'] = 'Group{}'.format(-chat_id)
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] \
+        if text.startswith('/') else []
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': text,
+                        'entities': entities, 'from': user, 'chat': chat}}
+
+
+def make_inline_update(update_id, user_id, query):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'User{}'.format(user_id)}
+    return {'update_id': update_id,
+            'inline_query': {'id': str(update_id), 'from': user, 'query': query, 'offset': ''}}
+
+
+def error_response(description):
+    code = 403 if description.startswith('Forbidden') else 400
+    response = {'ok': False, 'error_code': code, 'description': description}
+    if 'upgraded to a supergroup' in description:
+        new_uid = -1000000000000 - random.randrange(10 ** 6)
+        response['parameters'] = {'migrate_to_chat_id': new_uid}
+    return code, response
+
+
+def reply_message_id(params):
+    # PTB sends reply_parameters as a JSON string, other clients send reply_to_message_id
+    reply = params.get('reply_parameters')
+    if isinstance(reply, str):
+        try:
+            reply = json.loads(reply)
+        except ValueError:
+            reply = None
+    if isinstance(reply, dict) and 'message_id' in reply:
+        return int(reply['message_id'])
+    if params.get('reply_to_message_id') is not None:
+        return int(params['reply_to_message_id'])
+    return None
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    # a stand-in for api.telegram.org that serves queued updates and accepts sends. Replies are
+    # matched back to the update they answer to measure end-to-end latency
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, rate_limit=0.0,
+                 retry_after=1, error_rate=0.0, errors=()):
+        super().__init__(address, FakeBotApiHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.errors = list(errors)
+
+        self.updates = queue.Queue()
+        self.sent = []
+        self.calls = {}
+        self.rate_limited = 0
+        self.failed = 0
+        self.latencies = []
+        self.last_answered = None
+        self.lock = threading.Lock()
+        self._waiting = {}  # chat id -> deque of (message id, pushed at); inline id -> pushed at
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}/bot'.format(self.server_port)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def push(self, update):
+        # the clock for end-to-end latency starts when the update becomes available
+        pushed_at = time.monotonic()
+        with self.lock:
+            if 'inline_query' in update:
+                self._waiting[update['inline_query']['id']] = pushed_at
+            else:
+                message = update['message']
+                self._waiting.setdefault(message['chat']['id'], deque()).append(
+                    (message['message_id'], pushed_at))
+        self.updates.put(update)
+
+    def _answered(self, method, params):
+        now = time.monotonic()
+        with self.lock:
+            if method == 'answerInlineQuery':
+                pushed_at = self._waiting.pop(str(params.get('inline_query_id')), None)
+            else:
+                waiting = self._waiting.get(int(params.get('chat_id', 0)))
+                if not waiting:
+                    return
+                pushed_at = None
+                reply_to = reply_message_id(params)
+                if reply_to is not None:
+                    for i, (message_id, queued_at) in enumerate(waiting):
+                        if message_id == reply_to:
+                            pushed_at = queued_at
+                            del waiting[i]
+                            break
+                if pushed_at is None:
+                    pushed_at = waiting.popleft()[1]
+            if pushed_at is not None:
+                self.latencies.append(now - pushed_at)
+                self.last_answered = now
+
+    def get_updates(self, offset, limit, timeout):
+        updates = []
+        try:
+            update = self.updates.get(timeout=timeout)
+        except queue.Empty:
+            return updates
+        while True:
+            if update['update_id'] >= offset:
+                updates.append(update)
+            if len(updates) >= limit:
+                break
+            try:
+                update = self.updates.get_nowait()
+            except queue.Empty:
+                break
+        return updates
+
+    def call(self, method, params):
+        # returns (HTTP status, response body)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method != 'getUpdates' and (self.latency or self.jitter):
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if method in REPLY_METHODS or method == 'sendChatAction':
+            if random.random() < self.rate_limit:
+                with self.lock:
+                    self.rate_limited += 1
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': 'Too Many Requests: retry after {}'.format(
+                                 self.retry_after),
+                             'parameters': {'retry_after': self.retry_after}}
+            if self.errors and random.random() < self.error_rate:
+                with self.lock:
+                    self.failed += 1
+                self._answered(method, params)
+                return error_response(random.choice(self.errors))
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': BOT_USER}
+        if method in ('deleteWebhook', 'setWebhook', 'sendChatAction'):
+            return 200, {'ok': True, 'result': True}
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(
+                int(params.get('offset') or 0), int(params.get('limit') or 100),
+                min(float(params.get('timeout') or 0), 1.0))}
+        if method == 'answerInlineQuery':
+            self._answered(method, params)
+            return 200, {'ok': True, 'result': True}
+        if method == 'sendMessage':
+            self._answered(method, params)
+            with self.lock:
+                self.sent.append(params)
+                message_id = len(self.sent)
+            return 200, {'ok': True, 'result': {
+                'message_id': message_id, 'date': int(time.time()),
+                'text': params.get('text', ''),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}}
+        return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+    def stats(self):
+        with self.lock:
+            unanswered = sum(len(waiting) if isinstance(waiting, deque) else 1
+                             for waiting in self._waiting.values())
+            return {'calls': dict(self.calls), 'rate_limited': self.rate_limited,
+                    'failed': self.failed, 'answered': len(self.latencies),
+                    'unanswered': unanswered}
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = dict(parse_qsl(body.decode('utf8')))
+
+        method = self.path.rsplit('/', 1)[-1]
+        self.respond(*self.server.call(method, params))
+
+    do_GET = do_POST
+
+    def respond(self, status, payload):
+        data = json.dumps(payload).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except ConnectionError:
+            pass  # the client gave up on a long poll
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(updates, ports):
+    api = FakeBotApi()
+    for update in updates:
+        api.updates.put(update)
+    ports.put(api.server_port)
+    api.serve_forever()
+
+
+def start_process(updates=()):
+    # runs the fake API in its own process so it doesn't compete with the bot for the GIL
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(list(updates), ports), daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:{}/bot'.format(ports.get())
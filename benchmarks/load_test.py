@@ -0,0 +1,185 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from benchmarks.fake_bot_api import FakeBotApi, make_inline_update, make_update
+from constitutionbot import RECOGNIZED_ERRORS
+from references import AMENDMENT_COUNT, ARTICLE_SECTIONS
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+DEFAULT_MIX = 'get=50,getAmd=20,inline=20,group=10'
+
+INLINE_QUERIES = ['1:8', '3:2', 'amd1', 'amd 4', 'art2', 'commerce', '"due process"', 'speech']
+
+
+def random_reference():
+    article = random.randint(1, len(ARTICLE_SECTIONS))
+    if ARTICLE_SECTIONS[article]:
+        return '{}:{}'.format(article, random.randint(1, ARTICLE_SECTIONS[article]))
+    return str(article)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('get', 'getAmd', 'inline', 'group'):
+            raise ValueError('Unknown update kind: ' + kind)
+        weights[kind] = float(weight)
+    return weights
+
+
+def build_update(update_id, kind, users):
+    user_id = random.choice(users)
+    if kind == 'inline':
+        return make_inline_update(update_id, user_id, random.choice(INLINE_QUERIES))
+    if kind == 'getAmd':
+        return make_update(update_id, user_id,
+                           '/getAmd {}'.format(random.randint(1, AMENDMENT_COUNT)))
+    if kind == 'group':
+        return make_update(update_id, -100 - user_id % 20, '/get ' + random_reference(), user_id,
+                           chat_type='group')
+    return make_update(update_id, user_id, '/get ' + random_reference())
+
+
+def spawn_bot(api, users, corpus_path):
+    env = dict(os.environ, TELEGRAM_API_URL='http://127.0.0.1:{}'.format(api.server_port),
+               TG_TOKEN='TOKEN', ADMIN_ID='1', BOT_ID='2',
+               WHITELIST_IDS=','.join(map(str, users)))
+    env.setdefault('USER_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='load_test_'),
+                                                'users.db'))
+    if corpus_path is not None:
+        env['CORPUS_PATH'] = corpus_path
+    return subprocess.Popen([sys.executable, 'app.py', '--no-whitelist', '--no-login'], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def build_fixture_corpus():
+    from corpus import build_corpus
+
+    with open(os.path.join(FIXTURES_DIR, 'constitution.html'), encoding='utf8') as f:
+        constitution = f.read()
+    with open(os.path.join(FIXTURES_DIR, 'bill_of_rights.html'), encoding='utf8') as f:
+        amendments = f.read()
+    data, _ = build_corpus(constitution, amendments)
+    path = os.path.join(tempfile.mkdtemp(prefix='load_test_'), 'constitution.corpus')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def wait_for_bot(api, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if api.stats()['calls'].get('getUpdates'):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def generate(api, rate, duration, weights, users):
+    # open loop: updates go out on schedule whether or not the bot keeps up
+    kinds = list(weights)
+    total = int(rate * duration)
+    start = time.monotonic()
+    for i in range(total):
+        delay = start + i / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        kind = random.choices(kinds, [weights[k] for k in kinds])[0]
+        api.push(build_update(i + 1, kind, users))
+    return total
+
+
+def percentile(samples, fraction):
+    return samples[max(int(len(samples) * fraction) - 1, 0)] if samples else 0.0
+
+
+def summarize(api, generated, elapsed):
+    latencies = sorted(api.latencies)
+    stats = api.stats()
+    return {'generated': generated, 'answered': len(latencies),
+            'unanswered': stats['unanswered'], 'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p90_ms': percentile(latencies, 0.9) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+            'rate_limited': stats['rate_limited'], 'injected_errors': stats['failed'],
+            'calls': stats['calls']}
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Replays a mix of updates against a local fake Bot API '
+                                        'and reports end-to-end latency and throughput')
+    parser.add_argument('--rate', type=float, default=20, help='Updates per second')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to generate for')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Weights per update kind (default: {})'.format(DEFAULT_MIX))
+    parser.add_argument('--users', type=int, default=100, help='Distinct users')
+    parser.add_argument('--port', type=int, default=8081, help='Port for the fake Bot API')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the fake API takes per call')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Extra random latency')
+    parser.add_argument('--rate-limit', type=float, default=0.0, dest='rate_limit',
+                        help='Fraction of sends answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, dest='retry_after',
+                        help='retry_after given with injected 429s')
+    parser.add_argument('--error-rate', type=float, default=0.0, dest='error_rate',
+                        help='Fraction of sends failing with one of RECOGNIZED_ERRORS')
+    parser.add_argument('--spawn', action='store_true',
+                        help='Start app.py against the fake API (otherwise run it yourself with '
+                             'TELEGRAM_API_URL=http://127.0.0.1:PORT)')
+    parser.add_argument('--drain', type=float, default=15,
+                        help='Seconds to wait for outstanding replies')
+    parser.add_argument('-o', '--output', help='Write the summary as JSON')
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    users = list(range(10000, 10000 + args.users))
+    api = FakeBotApi(('127.0.0.1', args.port), args.latency, args.jitter, args.rate_limit,
+                     args.retry_after, args.error_rate, RECOGNIZED_ERRORS).start()
+
+    bot = None
+    if args.spawn:
+        corpus_path = None if 'CORPUS_PATH' in os.environ else build_fixture_corpus()
+        bot = spawn_bot(api, users, corpus_path)
+    print('Fake Bot API on {}, waiting for the bot to poll'.format(api.base_url))
+    if not wait_for_bot(api, 60):
+        print('The bot never called getUpdates')
+        if bot is not None:
+            bot.terminate()
+        sys.exit(1)
+
+    try:
+        start = time.monotonic()
+        generated = generate(api, args.rate, args.duration, weights, users)
+        deadline = time.monotonic() + args.drain
+        while api.stats()['unanswered'] and time.monotonic() < deadline:
+            time.sleep(0.1)
+        # throughput runs up to the last reply, not the end of the drain
+        summary = summarize(api, generated, (api.last_answered or start) - start)
+    finally:
+        if bot is not None:
+            bot.terminate()
+            bot.wait()
+        api.shutdown()
+
+    print('{generated} updates, {answered} answered, {unanswered} unanswered in {elapsed:.1f}s '
+          '({throughput:.1f}/s)'.format(**summary))
+    print('latency p50 {p50_ms:.1f} ms  p90 {p90_ms:.1f} ms  p99 {p99_ms:.1f} ms  '
+          'max {max_ms:.1f} ms'.format(**summary))
+    print('{rate_limited} rate limited, {injected_errors} injected errors, calls {calls}'.format(
+        **summary))
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import asyncio
+import functools
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCKING_POOL_SIZE = int(os.environ.get('BLOCKING_POOL_SIZE', 8))
+BLOCKING_TIMEOUT = float(os.environ.get('BLOCKING_TIMEOUT', 15))  # seconds
+
+_pool_size = BLOCKING_POOL_SIZE
+_timeout = BLOCKING_TIMEOUT
+_executor = None
+
+
+def configure(pool_size=None, timeout=None):
+    global _pool_size, _timeout, _executor
+    if pool_size is not None and pool_size != _pool_size:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        _pool_size = pool_size
+    if timeout is not None:
+        _timeout = timeout
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_pool_size, thread_name_prefix='blocking')
+    return _executor
+
+
+async def run_blocking(func, *args, timeout=None, **kwargs):
+    # the worker thread can't be interrupted, but the handler stops waiting on it
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+    return await asyncio.wait_for(future, timeout or _timeout)
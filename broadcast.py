@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import time
+
+from blocking import run_blocking
+from collections import Counter
+
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', 500))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 20))
+BROADCAST_CHECKPOINT = os.environ.get('BROADCAST_CHECKPOINT', 'broadcast.checkpoint.json')
+
+LOG_BROADCAST_PROGRESS = 'Broadcast: {} sent, {} failed, {:.1f} msg/s, cursor {}'
+LOG_BROADCAST_ERROR = 'Broadcast to uid {} failed: {}'
+
+
+class BroadcastReport:
+    def __init__(self, saved=None):
+        saved = saved or {}
+        self.sent = saved.get('sent', 0)
+        self.failed = saved.get('failed', 0)
+        self.errors = Counter(saved.get('errors', {}))
+        self.started = time.monotonic()
+        self.sent_this_run = 0
+
+    def record(self, error):
+        if error is None:
+            self.sent += 1
+            self.sent_this_run += 1
+        else:
+            self.failed += 1
+            self.errors[error] += 1
+
+    def rate(self):
+        return self.sent_this_run / max(time.monotonic() - self.started, 1e-9)
+
+    def to_dict(self):
+        return {'sent': self.sent, 'failed': self.failed, 'errors': dict(self.errors)}
+
+    def summary(self):
+        lines = ['Broadcast finished: {} sent, {} failed ({:.1f} msg/s)'.format(
+            self.sent, self.failed, self.rate())]
+        for error, count in self.errors.most_common():
+            lines.append('{}: {}'.format(error, count))
+        return '\n'.join(lines)
+
+
+def classify(result, recognized_errors):
+    if isinstance(result, BaseException):
+        return 'Error: ' + type(result).__name__
+    if result.get('ok'):
+        return None
+    description = str(result.get('description'))
+    return description if description in recognized_errors else 'Unrecognized error'
+
+
+async def run_broadcast(get_batch, send, recognized_errors, checkpoint,
+                        batch_size=BROADCAST_BATCH_SIZE, concurrency=BROADCAST_CONCURRENCY):
+    # get_batch(after_uid, batch_size) -> users ordered by uid; send(user) -> Bot API response
+    cursor = checkpoint.get('cursor')
+    report = BroadcastReport(checkpoint.get('report'))
+    semaphore = asyncio.Semaphore(concurrency)
+    if cursor is not None:
+        logging.info('Resuming broadcast after uid {}'.format(cursor))
+
+    async def deliver(user):
+        async with semaphore:
+            try:
+                result = await send(user)
+            except Exception as e:
+                logging.warning(LOG_BROADCAST_ERROR.format(user.get_uid(), e))
+                result = e
+        report.record(classify(result, recognized_errors))
+
+    while True:
+        batch = await run_blocking(get_batch, cursor, batch_size)
+        if not batch:
+            break
+
+        await asyncio.gather(*(deliver(user) for user in batch))
+
+        # only move the cursor once the whole batch is done so a resumed run skips nothing
+        cursor = batch[-1].get_uid()
+        checkpoint.update(cursor=cursor, report=report.to_dict())
+        logging.info(LOG_BROADCAST_PROGRESS.format(report.sent, report.failed, report.rate(),
+                                                   cursor))
+
+    checkpoint.clear()
+    return report
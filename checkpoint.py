@@ -0,0 +1,39 @@
+import json
+import logging
+import os
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **values):
+        self.state.update(values)
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning('Could not save checkpoint {}: {}'.format(self.path, e))
+
+    def clear(self):
+        self.state = {}
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
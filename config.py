@@ -0,0 +1,31 @@
+import os
+
+
+class Config:
+    # the bot's credentials and ids, read from the environment on first use rather than at
+    # import so tools and benchmarks can import the bot's modules without them
+    def __init__(self, token, admin_id, bot_id, whitelist_ids):
+        self.token = token
+        self.admin_id = admin_id
+        self.bot_id = bot_id
+        self.whitelist_ids = frozenset(whitelist_ids)
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        return cls(environ['TG_TOKEN'], environ['ADMIN_ID'], environ['BOT_ID'],
+                   [int(id_string) for id_string in environ['WHITELIST_IDS'].split(',')])
+
+
+_config = None
+
+
+def get_config():
+    global _config
+    if _config is None:
+        _config = Config.from_env()
+    return _config
+
+
+def set_config(config):
+    global _config
+    _config = config
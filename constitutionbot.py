@@ -1,31 +1,42 @@
+import asyncio
+import httpx
 import json
 import logging
-import os
-import re
-import requests
+import metrics
 import textwrap
-import uuid
-
-from bs4 import BeautifulSoup
-from datetime import datetime
+import threading
+import time
+import transport
+
+from blocking import run_blocking
+from broadcast import BROADCAST_CHECKPOINT, run_broadcast
+from checkpoint import Checkpoint
+from config import get_config
+from corpus import AMENDMENTS_URL, CONSTITUTION_URL, get_corpus, refresh_corpus
+from datetime import datetime, timedelta
 from functools import wraps
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler
-from telegram import constants, Update
+from inline_index import INLINE_CACHE_TIME, MAX_RESULTS, InlineIndex
+from passage_cache import get_passage_cache
+from passage_index import (AMENDMENT, ARTICLE, format_passage, get_index, passage_key,
+                           strip_markdown)
+from references import InvalidReference, ReferenceParser, resolve_references
+from search_index import SearchIndex
+from send_queue import OutboundQueue
+from singleflight import SingleFlight
+from source_cache import FetchError, default_cache, fetch_page
+from sweep import SWEEP_CHECKPOINT, run_sweep
+from telegram import Update
+from transport import TELEGRAM_API_URL
 from telegram.ext import CallbackContext, CommandHandler
+from user_store import get_store
 
-TG_TOKEN = os.environ['TG_TOKEN']
-ADMIN_ID = os.environ['ADMIN_ID']
-BOT_ID = os.environ['BOT_ID']
-WHITELIST_IDS = [int(id_string) for id_string in os.environ['WHITELIST_IDS'].split(',')]
+MAX_MESSAGE_LENGTH = 4096
+PASSAGE_SEPARATOR = '\n\n'
 
 # region text constants
 EMPTY = 'empty'
-
-TELEGRAM_URL = 'https://api.telegram.org/bot' + TG_TOKEN
-TELEGRAM_URL_SEND = TELEGRAM_URL + '/sendMessage'
-TELEGRAM_URL_CHAT_ACTION = TELEGRAM_URL + '/sendChatAction'
-JSON_HEADER = {'Content-Type': 'application/json;charset=utf-8'}
+ERROR_FETCHING = 'Error fetching passage.'
 
 LOG_SENT = '{} {} sent to uid {} ({})'
 LOG_ENQUEUED = 'Enqueued {} to uid {} ({})'
@@ -69,132 +80,283 @@ RECOGNIZED_ERRORS = ('PEER_ID_INVALID',
                      RECOGNIZED_ERROR_MIGRATE)
 # endregion
 
+MESSAGES = metrics.counter('constitutionbot_messages_total',
+                           'Messages Telegram answered, by msg_type and outcome',
+                           ('msg_type', 'outcome'))
+SEND_ERRORS = metrics.counter('constitutionbot_send_errors_total',
+                              'Failed sends, by recognized error', ('error',))
+
+
+def error_label(description):
+    # keeps the errors metric to a bounded set of labels
+    if description.startswith(RECOGNIZED_ERROR_PARSE):
+        return RECOGNIZED_ERROR_PARSE
+    return description if description in RECOGNIZED_ERRORS else 'unrecognized'
+
+
+def count_send_error(description):
+    SEND_ERRORS.inc(error_label(description))
+
+
+def telegram_url(method):
+    return TELEGRAM_API_URL + '/bot' + get_config().token + '/' + method
+
 
 def restricted(func):
     @wraps(func)
     def wrapped(update, context, *args, **kwargs):
         user_id = update.effective_user.id
-        if user_id not in WHITELIST_IDS:
+        if user_id not in get_config().whitelist_ids:
             print("Unauthorized access denied for {}.".format(user_id))
             return
         return func(update, context, *args, **kwargs)
     return wrapped
 
 
-def strip_markdown(string):
-    return string.replace('*', r'\*').replace('_', r'\_').replace('`', r'\`').replace('[', r'\[')
+passage_flight = SingleFlight()
+reference_parser = ReferenceParser()
 
 
 def get_passage(article, is_amendment=False):
-    # adjusted to account for two original amendments at the beginning
-    ordinals = ['second', 'third', 'fourth', 'fifth', 'sixth', 'seventh', 'eighth', 'ninth', 'tenth']
-    SOURCE_URL = 'https://en.wikisource.org/wiki/Constitution_of_the_United_States_of_America'
-    if is_amendment:
-        SOURCE_URL = 'https://en.wikisource.org/wiki/United_States_Bill_of_Rights'
+    key = passage_key(article, is_amendment)
+    corpus = get_corpus()
+    if corpus is not None and key in corpus:
+        return corpus.lookup(key)
 
-    try:
-        logging.debug('Began fetching from remote')
-        html = requests.get(SOURCE_URL).content.decode('utf8')
-        logging.debug('Finished fetching from remote')
-    except requests.HTTPError as e:
-        logging.warning('Error fetching passage:\n' + str(e))
-        return 'Error fetching passage.'
+    return passage_flight.do(key, load_passage, key)
 
-    # not sure if consistent/good
-    start = html.find('<div class="prp-pages-output')
-    end = html.find('<table>', start)
 
-    if is_amendment:
-        start = html.find('Article the twelfth')
+def load_passage(key):
+    is_amendment = key[0] == AMENDMENT
+    SOURCE_URL = AMENDMENTS_URL if is_amendment else CONSTITUTION_URL
 
-        if int(article) < 10:
-            start = html.find('Article the {}'.format(ordinals[int(article)]))
+    # another worker may already have fetched and parsed the current revision
+    shared = get_passage_cache()
+    if shared is not None:
+        version, passage = shared.lookup(SOURCE_URL, key)
+        if version is not None:
+            return passage if passage is not None else format_passage(key, [])
 
-        end = html.find('</tr>', start)
+    try:
+        index = parse_page(SOURCE_URL, is_amendment)
+    except FetchError as e:
+        logging.warning('Error fetching passage:\n' + str(e))
+        return ERROR_FETCHING
 
-    passage_html = html[start:end - 1]
-    soup = BeautifulSoup(passage_html, 'html.parser')
+    return index.lookup(key)
 
-    if is_amendment:
-        title = 'Amendment {}'.format(article)
-        selector = 'td'
-    else:
-        # format of html element ids: aIV[-s#][-c#]
-        article_id = 'a' + arabic_to_roman(int(article[0])) + '-s' + article[2]
-        title = 'Article {} Section {}'.format(article_id[1], article[2])
 
-        # need every dd.p in dl after article start
-        selector = '[id=' + article_id + '], [id^=' + article_id + ']'
+def parse_page(url, is_amendment=False, force=False):
+    page = fetch_page(url, force)
+    index = get_index(page, is_amendment, wait=force)
+    shared = get_passage_cache()
+    if shared is not None:
+        shared.publish(url, page.version, index.passages)
+    return index
 
-    header = '*' + strip_markdown(title.strip()) + '*'
 
-    # for tag in soup.select(selector):
-    #     print(tag.text)
+async def fetch_passage(article, is_amendment=False):
+    key = passage_key(article, is_amendment)
+    corpus = get_corpus()
+    if corpus is not None and key in corpus:
+        return corpus.lookup(key)
 
-    WANTED = 'bg-bot-passage-text'
-    needed_stripping = False
+    try:
+        return await passage_flight.do_async(key, run_blocking, get_passage, article, is_amendment)
+    except asyncio.TimeoutError:
+        logging.warning('Timed out fetching passage ' + article)
+        return ERROR_FETCHING
+
+
+def get_passages(references):
+    # every passage the references cover, from one pass over the corpus or the parsed pages
+    corpus = get_corpus()
+    if corpus is not None:
+        keys = resolve_references(references, corpus.keys())
+        return [corpus.lookup(key) if key in corpus else format_passage(key, []) for key in keys]
+
+    passages = {}
+    kinds = set(first[0] for first, _ in references)
+    for url, is_amendment in ((CONSTITUTION_URL, False), (AMENDMENTS_URL, True)):
+        if (AMENDMENT if is_amendment else ARTICLE) in kinds:
+            passages.update(parse_page(url, is_amendment).passages)
+    keys = resolve_references(references, passages)
+    return [passages.get(key) or format_passage(key, []) for key in keys]
+
+
+async def fetch_passages(references):
+    if get_corpus() is not None:
+        return get_passages(references)
+    return await run_blocking(get_passages, references)
+
+
+def get_all_passages():
+    corpus = get_corpus()
+    if corpus is not None:
+        return dict((key, corpus.lookup(key)) for key in corpus.keys())
+
+    passages = {}
+    for url, is_amendment in ((CONSTITUTION_URL, False), (AMENDMENTS_URL, True)):
+        passages.update(parse_page(url, is_amendment).passages)
+    return passages
+
+
+def corpus_revision():
+    corpus = get_corpus()
+    return corpus.revision if corpus is not None else None
+
+
+# the indexes remember the corpus revision they were built from, so they follow a corpus that
+# another worker's refresh swapped in
+_search_index = None
+_search_revision = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index():
+    global _search_index, _search_revision
+    revision = corpus_revision()
+    with _search_index_lock:
+        if _search_index is None or _search_revision != revision:
+            _search_index = SearchIndex(get_all_passages())
+            _search_revision = revision
+            logging.info('Built search index over {} passages'.format(len(_search_index.keys)))
+    return _search_index
+
+
+_inline_index = None
+_inline_revision = None
+_inline_index_lock = threading.Lock()
+
+
+def get_inline_index():
+    global _inline_index, _inline_revision
+    revision = corpus_revision()
+    with _inline_index_lock:
+        if _inline_index is None or _inline_revision != revision:
+            _inline_index = InlineIndex(get_all_passages())
+            _inline_revision = revision
+            logging.info('Built inline index over {} passages'.format(len(_inline_index.results)))
+    return _inline_index
+
+
+def refresh_sources():
+    # re-fetches both pages and re-parses whatever changed. The new corpus or indexes are only
+    # swapped in once built, so lookups keep getting the last good copy while this runs or if
+    # it fails with FetchError. Returns whether anything changed
+    global _search_index, _search_revision, _inline_index, _inline_revision
+    sources = ((CONSTITUTION_URL, False), (AMENDMENTS_URL, True))
+    if get_corpus() is not None:
+        constitution, amendments = [fetch_page(url, force=True).body for url, _ in sources]
+        changed = refresh_corpus(constitution, amendments)
+    else:
+        before = [default_cache.get_cached(url) for url, _ in sources]
+        after = [parse_page(url, is_amendment, force=True) for url, is_amendment in sources]
+        changed = any(page is None or page.version != index.version
+                      for page, index in zip(before, after))
+    if not changed:
+        return False
+
+    revision = corpus_revision()
+    passages = get_all_passages()
+    if _search_index is not None:
+        search_index = SearchIndex(passages)
+        with _search_index_lock:
+            _search_index, _search_revision = search_index, revision
+    if _inline_index is not None:
+        inline_index = InlineIndex(passages)
+        with _inline_index_lock:
+            _inline_index, _inline_revision = inline_index, revision
+    logging.info('Refreshed passages from WikiSource')
+    return True
 
-    for tag in soup.select(selector):
-        tag['class'] = WANTED
-        bad_strings = tag(text=re.compile(r'([*_`\[])'))
-        for bad_string in bad_strings:
-            stripped_text = strip_markdown(bad_string)
-            bad_string.replace_with(stripped_text)
-            needed_stripping = True
 
-    if needed_stripping:
-        logging.info('Stripped markdown')
+def prewarm():
+    # builds what the first lookups, searches and inline queries would otherwise build on demand
+    start = time.perf_counter()
+    get_store()
+    try:
+        get_inline_index()
+        get_search_index()
+    except FetchError as e:
+        logging.warning('Error prewarming passages:\n' + str(e))
+        return
+    logging.info('Prewarmed caches in {:.0f} ms'.format((time.perf_counter() - start) * 1000))
 
-    for tag in soup.select('br'):
-        tag.name = 'span'
-        tag.string = '\n'
 
-    for tag in soup.select('.text'):
-        tag.string = tag.text.rstrip()
+async def telegram_post(data, deadline=10):
+    return await transport.post(telegram_url('sendMessage'), data, timeout=deadline)
 
-    final_text = header + '\n\n'
-    for tag in soup(class_=WANTED):
-        final_text += tag.text.strip() + '\n\n'
 
-    logging.debug('Finished BeautifulSoup processing')
+outbound_queue = OutboundQueue(telegram_post)
 
-    return final_text.strip()
 
+async def telegram_query(uid, deadline=10):
+    data = json.dumps({'chat_id': uid, 'action': 'typing'})
+    return await transport.post(telegram_url('sendChatAction'), data, timeout=deadline)
 
-def arabic_to_roman(numeral):
-    roman = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII']
-    return roman[numeral-1]  # :trollface:
 
+async def post_chat_action(data):
+    return await transport.post(telegram_url('sendChatAction'), data, timeout=30)
 
-def telegram_post(data, deadline=10):
-    return requests.post(TELEGRAM_URL_SEND, data, headers=JSON_HEADER, timeout=deadline)
 
+# reachability checks go to a different method, so they get their own queue, but they draw on
+# the same global bucket as sends: together they stay within the Bot API's limit
+action_queue = OutboundQueue(post_chat_action, bucket=outbound_queue.bucket)
 
-def telegram_query(uid, deadline=10):
-    data = json.dumps({'chat_id': uid, 'action': 'typing'})
-    return requests.post(TELEGRAM_URL_CHAT_ACTION, data, headers=JSON_HEADER, timeout=deadline)
+
+async def query_chat(uid):
+    return await action_queue.enqueue(uid, json.dumps({'chat_id': uid, 'action': 'typing'}))
 
 
 class User:  # (db.Model):
-    def __init__(self, uname, f_name='', l_name=''):
-        self.uid = uuid.uuid4()
+    # slotted with an int chat id and epoch-second timestamps so sweeps and broadcasts can hold
+    # large batches; see benchmarks/bench_user_memory.py
+    __slots__ = ('uid', 'group', 'username', 'first_name', 'last_name', 'created',
+                 'last_received', 'last_sent', 'reply_to', 'promo')
+
+    def __init__(self, uid, uname, f_name='', l_name=''):
+        now = int(time.time())
+        self.uid = int(uid)  # chat id, the key_name
+        self.group = self.uid < 0
         self.username = uname  # db.StringProperty(indexed=False)
         self.first_name = f_name  # db.StringProperty(multiline=True, indexed=False)
         self.last_name = l_name  # db.StringProperty(multiline=True, indexed=False)
-        self.created = datetime.today()  # db.DateTimeProperty(auto_now_add=True)
-        self.last_received = datetime.today()  # DateTime (auto_now_add=True, indexed=False)
-        self.last_sent = datetime.today()  # db.DateTimeProperty(indexed=False)
+        self.created = now  # db.DateTimeProperty(auto_now_add=True)
+        self.last_received = now  # DateTime (auto_now_add=True, indexed=False)
+        self.last_sent = None  # db.DateTimeProperty(indexed=False)
         self.reply_to = ''  # db.StringProperty(multiline=True, indexed=False)
         self.promo = False  # db.BooleanProperty(default=False)
 
+    @classmethod
+    def from_row(cls, row):
+        uid, username, first_name, last_name, created, last_received, last_sent, reply_to, \
+            promo = row
+        user = cls.__new__(cls)
+        user.uid = uid
+        user.group = uid < 0
+        user.username = username
+        user.first_name = first_name
+        user.last_name = last_name
+        user.created = int(created)
+        user.last_received = int(last_received) if last_received is not None else None
+        user.last_sent = int(last_sent) if last_sent is not None else None
+        user.reply_to = reply_to
+        user.promo = bool(promo)
+        return user
+
+    def to_row(self):
+        return (self.uid, self.username, self.first_name, self.last_name, self.created,
+                self.last_received, self.last_sent, self.reply_to, int(self.promo))
+
     def get_uid(self):
         return str(self.uid)
 
     def get_name_string(self):
         def prep(string):
-            return string.encode('utf-8', 'ignore').strip()
+            return string.strip()
 
-        name = prep(self.first_name)
+        name = prep(self.first_name or '')
         if self.last_name:
             name += ' ' + prep(self.last_name)
         if self.username:
@@ -207,63 +369,77 @@ class User:  # (db.Model):
         return user_type + ' ' + self.get_name_string()
 
     def is_group(self):
-        return int(self.get_uid()) < 0
+        return self.group
+
+    def put(self):
+        get_store().put(self.to_row())
+
+    def delete(self):
+        get_store().delete(self.uid)
 
     def set_promo(self, promo):
         self.promo = promo
-        # self.put()
+        self.put()
 
     def update_last_received(self):
-        self.last_received = datetime.now()
-        # self.put()
+        self.last_received = int(time.time())
+        self.put()
 
     def update_last_sent(self):
-        self.last_sent = datetime.now()
-        # self.put()
+        self.last_sent = int(time.time())
+        self.put()
 
     def await_reply(self, command):
         if command is not None and len(command) > 1500:
             command = command[:1500]
         self.reply_to = command
-        # self.put()
+        self.put()
 
     def migrate_to(self, uid):
-        # props = dict((prop, getattr(self, prop)) for prop in self.properties().keys())
-        # props.update(key_name=str(uid))
-        new_user = User(self)  # **props)
-        # new_user.put()
-        # self.delete()
+        new_user = User.from_row((int(uid),) + self.to_row()[1:])
+        new_user.put()
+        self.delete()
         return new_user
 
 
 def get_user(uid):
-    # key = db.Key.from_path('User', str(uid))
-    # user = db.get(key)
-    if True:  # user == None:
-        user = User('-', '-')
-        # user.put()
-    return user
+    row = get_store().get(int(uid))
+    if row is None:
+        user = User(uid, '-', '-')
+        user.put()
+        return user
+    return User.from_row(row)
 
 
 def user_exists(uid):
-    # key = db.Key.from_path('User', str(uid))
-    # user = db.get(key)
-    return False  # user != None
+    return get_store().get(int(uid)) is not None
+
+
+def get_user_batch(after_uid=None, batch_size=500, promo=None, created_before=None):
+    if after_uid is not None:
+        after_uid = int(after_uid)
+    rows = get_store().batch(after_uid, batch_size, promo, created_before)
+    return [User.from_row(row) for row in rows]
+
+
+def apply_user_changes(migrations, deletions):
+    for uid, new_uid in migrations:
+        get_user(uid).migrate_to(new_uid)
+        logging.info(LOG_USER_MIGRATED.format(uid, new_uid, 'chat'))
+    for uid in deletions:
+        get_store().delete(int(uid))
+        logging.info(LOG_USER_DELETED.format(uid, 'chat'))
+    # commit the whole batch in one transaction
+    get_store().flush()
 
 
 def update_profile(uid, uname, f_name, l_name):
     existing_user = get_user(uid)
-    if existing_user:
-        existing_user.username = uname
-        existing_user.first_name = f_name
-        existing_user.last_name = l_name
-        existing_user.update_last_received()
-        # existing_user.put()
-        return existing_user
-    else:
-        user = User(uname, f_name, l_name)
-        # user.put()
-        return user
+    existing_user.username = uname
+    existing_user.first_name = f_name
+    existing_user.last_name = l_name
+    existing_user.update_last_received()
+    return existing_user
 
 
 def build_buttons(menu):
@@ -282,21 +458,47 @@ def build_inline_switch_keyboard(text, query=''):
     return {'inline_keyboard': [[inline_switch_button]]}
 
 
-def send_message(user_or_uid, text, msg_type='message', force_reply=False, is_markdown=False,
-                 disable_web_page_preview=True, custom_keyboard=None, hide_keyboard=False):
-    try:
-        uid = str(user_or_uid.get_uid())
-        user = user_or_uid
-    except AttributeError:
-        uid = str(user_or_uid)
-        user = get_user(user_or_uid)
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    if len(text) > limit:
+        return textwrap.wrap(text, limit, replace_whitespace=False, drop_whitespace=False)
+    return [text]
+
+
+def pack_messages(texts, limit=MAX_MESSAGE_LENGTH):
+    # as few messages as possible without reordering: each takes passages while they fit, and
+    # the last chunk of a passage over the limit can share a message with the next one
+    messages = []
+    current = ''
+    for text in texts:
+        for chunk in split_message(text, limit):
+            if current and len(current) + len(PASSAGE_SEPARATOR) + len(chunk) <= limit:
+                current += PASSAGE_SEPARATOR + chunk
+                continue
+            if current:
+                messages.append(current)
+            current = chunk
+    if current:
+        messages.append(current)
+    return messages
+
+
+def build_message(uid, text, msg_type='message', force_reply=False, is_markdown=False,
+                  disable_web_page_preview=True, custom_keyboard=None, hide_keyboard=False,
+                  reply_to_message_id=None):
+    # one sendMessage payload per 4096-character chunk
+    if text.strip() == '':
+        return []
 
-    def send_short_message(msg_text):
+    builds = []
+    for chunk in split_message(text):
         build = {
             'chat_id': uid,
-            'text': msg_text.replace('\a', ' ')
+            'text': chunk.replace('\a', ' ')
         }
 
+        if reply_to_message_id and not builds:
+            build['reply_to_message_id'] = reply_to_message_id
+
         if force_reply:
             build['reply_markup'] = dict(force_reply=force_reply)
         elif custom_keyboard:
@@ -310,57 +512,90 @@ def send_message(user_or_uid, text, msg_type='message', force_reply=False, is_ma
         if disable_web_page_preview:
             build['disable_web_page_preview'] = disable_web_page_preview
 
-        data = json.dumps(build)
+        builds.append(build)
+    return builds
 
-        def queue_message():
-            requests.post(TELEGRAM_URL_SEND, data, headers=JSON_HEADER, timeout=10)
-            logging.info(LOG_ENQUEUED.format(msg_type, uid, user.get_description()))
 
-        if msg_type == 'promo':
-            user.set_promo(True)
-            queue_message()
+async def send_message(user_or_uid, text, msg_type='message', force_reply=False,
+                       is_markdown=False, disable_web_page_preview=True, custom_keyboard=None,
+                       hide_keyboard=False, reply_to_message_id=None):
+    return await send_messages(user_or_uid, [text], msg_type, force_reply, is_markdown,
+                               disable_web_page_preview, custom_keyboard, hide_keyboard,
+                               reply_to_message_id)
+
+
+async def send_messages(user_or_uid, texts, msg_type='message', force_reply=False,
+                        is_markdown=False, disable_web_page_preview=True, custom_keyboard=None,
+                        hide_keyboard=False, reply_to_message_id=None):
+    try:
+        uid = str(user_or_uid.get_uid())
+        user = user_or_uid
+    except AttributeError:
+        uid = str(user_or_uid)
+        user = get_user(user_or_uid)
+
+    def handle_delivery(future):
+        if future.cancelled():
             return
+        if future.exception() is not None:
+            logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(),
+                                                     str(future.exception())))
+        else:
+            handle_response(future.result(), user, uid, msg_type)
 
+    def queue_message(build):
+        future = outbound_queue.enqueue(uid, json.dumps(build))
+        future.add_done_callback(handle_delivery)
+        logging.info(LOG_ENQUEUED.format(msg_type, uid, user.get_description()))
+        return future
+
+    async def send_short_message(build, future):
+        # the queue has already retried network errors, unreadable responses, 429s and 5xx
+        # responses by now
         try:
-            result = telegram_post(data)
-        except requests.HTTPError as e:
+            response = await future
+        except (httpx.HTTPError, ValueError) as e:
             logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(), str(e)))
-            queue_message()
-            return
+            return future
 
-        response = json.loads(result.content)
         error_description = str(response.get('description'))
 
         if error_description.startswith(RECOGNIZED_ERROR_PARSE):
+            # resent as plain text, after any chunks already queued behind it
             if build.get('parse_mode'):
                 del build['parse_mode']
-            data = json.dumps(build)
-            queue_message()
+            return queue_message(build)
 
-        elif not handle_response(response, user, uid, msg_type):
-            queue_message()
+        handle_response(response, user, uid, msg_type)
+        return future
 
-    if text.strip() == '':
-        return
+    builds = []
+    for i, text in enumerate(texts):
+        builds += build_message(uid, text, msg_type, force_reply, is_markdown,
+                                disable_web_page_preview, custom_keyboard, hide_keyboard,
+                                reply_to_message_id if i == 0 else None)
 
-    if len(text) > 4096:
-        chunks = textwrap.wrap(text, 4096, replace_whitespace=False, drop_whitespace=False)
-        i = 0
-        for chunk in chunks:
-            send_short_message(chunk)
-            i += 1
-    else:
-        send_short_message(text)
+    if msg_type == 'promo':
+        user.set_promo(True)
+        return [queue_message(build) for build in builds]
+
+    # every chunk is queued before the first is awaited, so the chat's queue sends them back to
+    # back and in order; one delivery future per chunk
+    futures = [outbound_queue.enqueue(uid, json.dumps(build)) for build in builds]
+    return [await send_short_message(build, future) for build, future in zip(builds, futures)]
 
 
 def handle_response(response, user, uid, msg_type):
     if response.get('ok'):
         msg_id = str(response.get('result').get('message_id'))
         logging.info(LOG_SENT.format(msg_type.capitalize(), msg_id, uid, user.get_description()))
+        MESSAGES.inc(msg_type, 'sent')
         user.update_last_sent()
 
     else:
         error_description = str(response.get('description'))
+        MESSAGES.inc(msg_type, 'failed')
+        SEND_ERRORS.inc(error_label(error_description))
         if error_description.startswith(RECOGNIZED_ERROR_PARSE):
             logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(),
                                                      error_description))
@@ -390,12 +625,11 @@ def handle_response(response, user, uid, msg_type):
     return True
 
 
-def send_typing(uid):
+async def send_typing(uid):
     data = json.dumps({'chat_id': uid, 'action': 'typing'})
     try:
-        # rpc = requests.create_rpc()
-        requests.post(TELEGRAM_URL_CHAT_ACTION, data, headers=JSON_HEADER)
-    except requests.HTTPError:
+        await transport.post(telegram_url('sendChatAction'), data)
+    except httpx.HTTPError:
         return
 
 
@@ -406,7 +640,8 @@ async def main_cmd(update: Update, context: CallbackContext):
     BOT_HANDLE = '@' + BOT_USERNAME
     BOT_DESCRIPTION = 'This bot can fetch US Constitution passages from [WikiSource](wikisource.org).'
 
-    CMD_LIST = '/get <article>[:<section>]\n/getAmd <number>\nExamples:\n/get 3:2\n/getAmd 1\n' + \
+    CMD_LIST = '/get <article>[:<section>]\n/getAmd <number>\n/search <words>\n' + \
+               'Examples:\n/get 3:2\n/get 1:8-1:10,2:1\n/getAmd 1-10\n/search "due process"\n' + \
                'Inline mode:\n' + BOT_HANDLE + ' 3:2\n' + BOT_HANDLE + ' amd1'
 
     WELCOME_GROUP = 'Hello, friends in {}! Thanks for adding me in!'
@@ -438,11 +673,23 @@ async def main_cmd(update: Update, context: CallbackContext):
 
     if inline_query:
         words = inline_query.strip().split()
+        is_amendment = words[0].upper().startswith('/GETAMD')
 
-        if len(words) > 1 and words[0].upper() == '/GETAMD':
-            response = get_passage(words[1], True)
-        else:
-            response = get_passage(words[1])
+        # checked against the bounds table before anything is fetched
+        reference = ''.join(words[1:])
+        try:
+            references = reference_parser.parse(reference, is_amendment)
+        except InvalidReference as e:
+            logging.info(LOG_ERROR_INVALID_QUICK + reference)
+            await send_message(update.message.chat_id, str(e),
+                               reply_to_message_id=update.message.id)
+            return
+
+        if len(references) > 1 or references[0][1] is not None:
+            await answer_batch(update, references)
+            return
+
+        response = await fetch_passage(reference, is_amendment)
 
         results = []
 
@@ -462,19 +709,13 @@ async def main_cmd(update: Update, context: CallbackContext):
                         'thumb_url': ''}]
 
         payload = {'method': 'answerInlineQuery', 'results': results,
-                   'switch_pm_parameter': 'setdefault', 'cache_time': 0}
+                   'switch_pm_parameter': 'setdefault', 'cache_time': INLINE_CACHE_TIME}
 
         output = json.dumps(payload)
 
-        if len(response) > 4096:
-            response = response[:4093] + '...'
-
-        await context.bot.send_message(
-            update.message.chat_id,
-            response,
-            constants.ParseMode.MARKDOWN_V2,
-            reply_to_message_id=update.message.id
-        )
+        # through the outbound queue like every other reply, chunked and in Markdown
+        await send_message(update.message.chat_id, response, 'passage',
+                           reply_to_message_id=update.message.id)
         logging.info('Answered inline query')
         logging.debug(output)
         return
@@ -525,7 +766,7 @@ async def main_cmd(update: Update, context: CallbackContext):
     if user.last_sent is None or text == '/start':
         if user.is_group() and msg.new_chat_members:
             new_chat_member_ids = [str(m.id) for m in msg.new_chat_members]
-            if BOT_ID not in new_chat_member_ids:
+            if get_config().bot_id not in new_chat_member_ids:
                 logging.info(LOG_TYPE_NEW_PARTICIPANT)
                 return
 
@@ -542,7 +783,7 @@ async def main_cmd(update: Update, context: CallbackContext):
             response = WELCOME_USER.format(name)
 
         response += WELCOME_GET_STARTED
-        send_message(user, response, 'welcome', custom_keyboard=TRY_KEYBOARD)
+        await send_message(user, response, 'welcome', custom_keyboard=TRY_KEYBOARD)
         user.await_reply(None)
 
         if new_user:
@@ -582,7 +823,7 @@ async def main_cmd(update: Update, context: CallbackContext):
 
     if is_command('get'):
         user.await_reply('get')
-        send_message(user, GET_PASSAGE, force_reply=True)
+        await send_message(user, GET_PASSAGE, force_reply=True)
     elif is_get_command():
         user.await_reply(None)
         words = text.split()
@@ -591,7 +832,7 @@ async def main_cmd(update: Update, context: CallbackContext):
         passage = text[len(first_word) + 1:].strip()
         if not passage:
             user.await_reply(first_word[1:])
-            send_message(user, GET_PASSAGE, force_reply=True)
+            await send_message(user, GET_PASSAGE, force_reply=True)
             return
 
         first_passage_word = passage.split()[0].upper()
@@ -599,20 +840,30 @@ async def main_cmd(update: Update, context: CallbackContext):
         if len(first_word) == 4 and passage[len(first_passage_word) + 1:].strip():
             passage = passage[len(first_passage_word) + 1:]
 
-        send_typing(uid)
-        response = get_passage(passage, first_passage_word == 'AMD')
+        is_amendment = first_passage_word == 'AMD' or first_word.upper() == '/GETAMD'
+        try:
+            references = reference_parser.parse(passage, is_amendment)
+        except InvalidReference as e:
+            await send_message(user, str(e))
+            return
+        if len(references) > 1 or references[0][1] is not None:
+            await answer_batch(update, references)
+            return
+
+        await send_typing(uid)
+        response = await fetch_passage(passage, is_amendment)
 
         if response == EMPTY:
-            send_message(user, NO_RESULTS_FOUND.format(name))
+            await send_message(user, NO_RESULTS_FOUND.format(name))
             return
         elif response is None:
-            send_message(user, REMOTE_ERROR.format(name))
+            await send_message(user, REMOTE_ERROR.format(name))
             return
 
-        send_message(user, response, 'passage')
+        await send_message(user, response, 'passage')
     elif is_command('help'):
         user.await_reply(None)
-        send_message(user, HELP.format(name), custom_keyboard=TRY_KEYBOARD)
+        await send_message(user, HELP.format(name), custom_keyboard=TRY_KEYBOARD)
 
     # elif is_command('settings'):
     #     user.await_reply(None)
@@ -622,27 +873,111 @@ async def main_cmd(update: Update, context: CallbackContext):
         is_amendment = user.reply_to[3:].upper() == 'AMD'
         user.await_reply(None)
 
-        send_typing(uid)
-        response = get_passage(text, is_amendment)
+        try:
+            references = reference_parser.parse(text, is_amendment)
+        except InvalidReference as e:
+            await send_message(user, str(e), hide_keyboard=True)
+            return
+        if len(references) > 1 or references[0][1] is not None:
+            await answer_batch(update, references)
+            return
+
+        await send_typing(uid)
+        response = await fetch_passage(text, is_amendment)
 
         if response == EMPTY:
-            send_message(user, NO_RESULTS_FOUND.format(name), hide_keyboard=True)
+            await send_message(user, NO_RESULTS_FOUND.format(name), hide_keyboard=True)
             return
         elif response is None:
-            send_message(user, REMOTE_ERROR.format(name), hide_keyboard=True)
+            await send_message(user, REMOTE_ERROR.format(name), hide_keyboard=True)
             return
 
-        send_message(user, response, 'passage', hide_keyboard=True)
+        await send_message(user, response, 'passage', hide_keyboard=True)
     else:
         user.await_reply(None)
         msg_reply = msg.reply_to_message
         if user.is_group() and BOT_HANDLE not in text and \
-                not (msg_reply and str(msg_reply.from_user.id) == BOT_ID):
+                not (msg_reply and str(msg_reply.from_user.id) == get_config().bot_id):
             logging.info(LOG_UNRECOGNIZED)
             return
 
         logging.info(LOG_UNRECOGNIZED)
-        send_message(user, UNRECOGNIZED.format(name), custom_keyboard=TRY_KEYBOARD)
+        await send_message(user, UNRECOGNIZED.format(name), custom_keyboard=TRY_KEYBOARD)
+
+
+async def answer_batch(update, references):
+    NO_PASSAGES = 'Sorry, no passages were found. Please try again.'
+
+    uid = str(update.message.chat_id)
+    try:
+        passages = await fetch_passages(references)
+    except (FetchError, asyncio.TimeoutError) as e:
+        logging.warning('Error fetching passages:\n' + str(e))
+        passages = None
+
+    if passages is None:
+        await send_message(uid, ERROR_FETCHING)
+        return
+    if not passages:
+        await send_message(uid, NO_PASSAGES)
+        return
+
+    messages = pack_messages(passages)
+    await send_messages(uid, messages, 'passage', reply_to_message_id=update.message.id)
+    logging.info('Answered {} passages in {} messages'.format(len(passages), len(messages)))
+
+
+@restricted
+async def search_cmd(update: Update, context: CallbackContext):
+    USAGE = 'Usage: /search <words>\nUse "quotes" for phrases and * for prefixes, ' + \
+            'e.g. /search "due process" tax*'
+    NO_RESULTS_FOUND = 'Sorry, no passages matched {}.'
+
+    query = ' '.join(context.args or []).strip()
+    if not query:
+        response = strip_markdown(USAGE)
+    else:
+        try:
+            index = await run_blocking(get_search_index)
+        except (FetchError, asyncio.TimeoutError) as e:
+            logging.warning('Error building search index:\n' + str(e))
+            index = None
+
+        if index is None:
+            response = ERROR_FETCHING
+        else:
+            start = time.perf_counter()
+            results = index.search(query)
+            logging.info('Searched "{}": {} results in {:.2f} ms'.format(
+                query, len(results), (time.perf_counter() - start) * 1000))
+
+            if results:
+                response = '\n\n'.join(strip_markdown(title + '\n' + snippet)
+                                         for _, title, snippet in results)
+            else:
+                response = strip_markdown(NO_RESULTS_FOUND.format(query))
+
+    await send_message(update.message.chat_id, response, 'result',
+                       reply_to_message_id=update.message.id)
+
+
+@restricted
+async def inline_query_cmd(update: Update, context: CallbackContext):
+    query = update.inline_query.query
+    try:
+        index = await run_blocking(get_inline_index)
+    except (FetchError, asyncio.TimeoutError) as e:
+        logging.warning('Error building inline index:\n' + str(e))
+        return
+
+    results = index.lookup(query)
+    if not results and query.strip():
+        # nothing by reference or title, fall back to the words of the passages
+        search = await run_blocking(get_search_index)
+        results = index.results_for(key for key, _, _ in search.search(query, MAX_RESULTS))
+
+    await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+    logging.info('Answered inline query')
 
 
 @restricted
@@ -651,14 +986,14 @@ async def message_cmd(update: Update, context: CallbackContext):
     data = update.message
     uid = str(data.chat_id)
     user = get_user(uid)
-    result = requests.models.Response()
 
     try:
-        result = telegram_post(data, deadline=30)
-    except requests.HTTPError as e:
+        result = await telegram_post(data, deadline=30)
+    except httpx.HTTPError as e:
         logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(), str(e)))
         logging.debug(data)
         logging.error(HTTPStatus.BAD_GATEWAY)  # 502
+        return
 
     response = json.loads(result.content)
 
@@ -667,91 +1002,154 @@ async def message_cmd(update: Update, context: CallbackContext):
         logging.error(HTTPStatus.BAD_GATEWAY)  # 502
 
 
-@restricted
-class MigratePage(BaseHTTPRequestHandler):
-    def get(self):
-        self.send_header('Content-Type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(bytes('Migrate page\n', 'utf-8'))
+def build_promo_message(user):
+    name = user.first_name.strip()
+    if user.is_group():
+        promo_msg = 'Hello, friends in {}! '.format(name) + \
+                    'Do you find Constitution Bot useful?'
+    else:
+        promo_msg = 'Hi {}, do you find Constitution Bot useful?'.format(name)
+    promo_msg += ' Why not rate it on the bot store (you don\'t have to exit Telegram)!\n' + \
+                 'https://telegram.me/storebot?start=usconstitutionbot'
+    return promo_msg
 
 
-@restricted
-class PromoPage(BaseHTTPRequestHandler):
-    # @staticmethod
-    # def get():
-    #     taskqueue.add(url='/promo')
-
-    def post(self):
-        params = json.loads(self.request.body)
-        data = params.get('data')
-        uid = str(json.loads(data).get('chat_id'))
-        user = get_user(uid)
-        # three_days_ago = datetime.now() - timedelta(days=3)
-        # query = User.all()
-        # query.filter('promo =', False)
-        # query.filter('created <', three_days_ago)
-        # for user in query.run(batch_size=500):
-        name = user.first_name.encode('utf-8', 'ignore').strip()
-        if user.is_group():
-            promo_msg = 'Hello, friends in {}! '.format(name) + \
-                        'Do you find Constitution Bot useful?'
-        else:
-            promo_msg = 'Hi {}, do you find Constitution Bot useful?'.format(name)
-        promo_msg += ' Why not rate it on the bot store (you don\'t have to exit Telegram)!\n' + \
-                     'https://telegram.me/storebot?start=usconstitutionbot'
-        send_message(user, promo_msg, 'promo')
+async def send_promo(user):
+    futures = await send_message(user, build_promo_message(user), 'promo')
+    return (await asyncio.gather(*futures))[-1]
+
+
+def get_promo_batch(after_uid, batch_size):
+    three_days_ago = int((datetime.now() - timedelta(days=3)).timestamp())
+    return get_user_batch(after_uid, batch_size, promo=False, created_before=three_days_ago)
+
+
+_broadcast_running = False
 
 
 @restricted
-class VerifyPage(BaseHTTPRequestHandler):
-    def get(self):
-        try:
-            # query = User.all()
-            # for user in query.run(batch_size=3000):
-            # uid = str(user.get_uid())
-            # taskqueue.add(url='/verify', payload=uid)
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(bytes('Cleanup in progress\n', 'utf-8'))
-        except Exception as e:
-            logging.error(e)
-
-    def post(self):
-        uid = self.request.body
-        user = get_user(uid)
-        result = {}
+async def promo_cmd(update: Update, context: CallbackContext):
+    global _broadcast_running
+    chat_id = update.message.chat_id
+    if str(update.effective_user.id) != get_config().admin_id:
+        return
+    if _broadcast_running:
+        await context.bot.send_message(chat_id, 'A broadcast is already running.')
+        return
+
+    checkpoint = Checkpoint(BROADCAST_CHECKPOINT)
+    if context.args and context.args[0] == 'restart':
+        checkpoint.clear()
+
+    async def broadcast():
+        global _broadcast_running
         try:
-            result = telegram_query(uid, 30)
-        except Exception as e:
-            logging.warning(LOG_ERROR_QUERY.format(uid, user.get_description(), str(e)))
-            self.send_error(HTTPStatus.BAD_GATEWAY)  # 502
+            report = await run_broadcast(get_promo_batch, send_promo, RECOGNIZED_ERRORS,
+                                         checkpoint)
+        finally:
+            _broadcast_running = False
+        await context.bot.send_message(chat_id, report.summary())
+
+    if checkpoint.get('cursor') is None:
+        await context.bot.send_message(chat_id, 'Broadcast started.')
+    else:
+        await context.bot.send_message(
+            chat_id, 'Broadcast resumed after uid {}.'.format(checkpoint.get('cursor')))
+    # runs in the background so other updates keep being handled
+    _broadcast_running = True
+    context.application.create_task(broadcast(), update=update)
+
+
+_sweep_stop = None
+
+
+@restricted
+async def verify_cmd(update: Update, context: CallbackContext):
+    global _sweep_stop
+    chat_id = update.message.chat_id
+    if str(update.effective_user.id) != get_config().admin_id:
+        return
 
-        response = json.loads(result.content)
+    command = context.args[0] if context.args else ''
+    if command == 'stop':
+        if _sweep_stop is not None:
+            _sweep_stop.set()
+        await context.bot.send_message(chat_id, 'Cleanup will pause after the current batch.')
+        return
+    if _sweep_stop is not None:
+        await context.bot.send_message(chat_id, 'Cleanup is already running.')
+        return
 
-        if response.get('ok'):
-            logging.info(LOG_USER_REACHABLE.format(uid, user.get_description()))
+    checkpoint = Checkpoint(SWEEP_CHECKPOINT)
+    if command == 'restart':
+        checkpoint.clear()
+
+    async def sweep():
+        global _sweep_stop
+        try:
+            report = await run_sweep(get_user_batch, query_chat, apply_user_changes,
+                                     RECOGNIZED_ERRORS, RECOGNIZED_ERROR_MIGRATE, checkpoint,
+                                     stop=_sweep_stop)
+        finally:
+            _sweep_stop = None
+        if checkpoint.get('cursor') is None:
+            await context.bot.send_message(chat_id, report.summary())
         else:
-            error_description = str(response.get('description'))
-            if error_description == RECOGNIZED_ERROR_MIGRATE:
-                new_uid = response.get('parameters', {}).get('migrate_to_chat_id')
-                if new_uid:
-                    user = user.migrate_to(new_uid)
-                    logging.info(LOG_USER_MIGRATED.format(uid, new_uid, user.get_description()))
-            elif error_description in RECOGNIZED_ERRORS:
-                user_description = user.get_description()
-                # user.delete()
-                logging.info(LOG_USER_DELETED.format(uid, user_description))
-            else:
-                logging.warning(LOG_USER_UNREACHABLE.format(uid, user.get_description(),
-                                                            error_description))
-                self.send_error(HTTPStatus.BAD_GATEWAY)  # 502
+            await context.bot.send_message(
+                chat_id, 'Cleanup paused after uid {} ({}).'.format(checkpoint.get('cursor'),
+                                                                    report.describe()))
+
+    if checkpoint.get('cursor') is None:
+        await context.bot.send_message(chat_id, 'Cleanup in progress')
+    else:
+        await context.bot.send_message(
+            chat_id, 'Cleanup resumed after uid {}.'.format(checkpoint.get('cursor')))
+    _sweep_stop = asyncio.Event()
+    context.application.create_task(sweep(), update=update)
+
+
+def cache_stats():
+    user_cache = get_store().cache
+    stats = {('source', 'hit'): default_cache.hits, ('source', 'miss'): default_cache.misses,
+             ('user', 'hit'): user_cache.hits, ('user', 'miss'): user_cache.misses,
+             ('passage', 'coalesced'): passage_flight.coalesced,
+             ('rejected', 'hit'): reference_parser.hits,
+             ('rejected', 'miss'): reference_parser.rejected}
+    shared = get_passage_cache()
+    if shared is not None:
+        stats[('shared', 'hit')] = shared.hits
+        stats[('shared', 'miss')] = shared.misses
+    return stats
+
+
+metrics.callback('constitutionbot_cache_lookups_total', 'Cache lookups, by cache and result',
+                 'counter', cache_stats, ('cache', 'result'))
+metrics.callback('constitutionbot_cache_hit_ratio', 'Share of lookups served from cache',
+                 'gauge', lambda: {('source',): default_cache.hits / max(
+                     default_cache.hits + default_cache.misses, 1),
+                     ('user',): get_store().cache.hit_rate()}, ('cache',))
+metrics.callback('constitutionbot_source_stale_total', 'Stale WikiSource pages served after a '
+                 'failed fetch', 'counter', lambda: default_cache.stale)
+metrics.callback('constitutionbot_source_breaker_open', 'Whether WikiSource fetches are paused '
+                 'after repeated failures', 'gauge', lambda: int(default_cache.breaker.is_open()))
+metrics.callback('constitutionbot_user_cache_evictions_total', 'Users evicted from the cache',
+                 'counter', lambda: get_store().cache.evictions)
+metrics.callback('constitutionbot_send_queue_depth', 'Bot API sends waiting in a queue', 'gauge',
+                 lambda: {('sendMessage',): outbound_queue.pending,
+                          ('sendChatAction',): action_queue.pending}, ('queue',))
+metrics.callback('constitutionbot_send_retries_total', 'Bot API sends retried', 'counter',
+                 lambda: {('sendMessage',): outbound_queue.retried,
+                          ('sendChatAction',): action_queue.retried}, ('queue',))
+metrics.callback('constitutionbot_user_writes_pending', 'User changes not yet written to the '
+                 'database', 'gauge', lambda: get_store().stats()['dirty'])
 
 
 app_handler = [
      CommandHandler('get', main_cmd),
      CommandHandler('getAmd', main_cmd),
+     CommandHandler('search', search_cmd),
      CommandHandler('message', message_cmd),
-     # CommandHandler('/promo', PromoPage),
-     # CommandHandler ('/migrate', MigratePage),
-     # CommandHandler('/verify', VerifyPage),
+     CommandHandler('promo', promo_cmd),
+     # CommandHandler ('/migrate', pages.MigratePage),
+     CommandHandler('verify', verify_cmd),
 ]
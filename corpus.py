@@ -0,0 +1,220 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from argparse import ArgumentParser
+from passage_index import AMENDMENT, ARTICLE, build_amendment_passages, build_article_passages
+
+CORPUS_PATH = os.environ.get('CORPUS_PATH', 'constitution.corpus')
+CORPUS_CHECK = float(os.environ.get('CORPUS_CHECK', 2))  # seconds between checks for a new file
+MIN_PASSAGE_SHARE = 0.5  # of each page's loaded passages a rebuild needs to replace them
+CONSTITUTION_URL = 'https://en.wikisource.org/wiki/Constitution_of_the_United_States_of_America'
+AMENDMENTS_URL = 'https://en.wikisource.org/wiki/United_States_Bill_of_Rights'
+AMENDMENT_COUNT = 27
+
+# file layout: header, offset table, utf-8 text blob
+MAGIC = b'USCB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sH40sI')  # magic, format version, source revision, entry count
+ENTRY = struct.Struct('<BHHII')  # kind, number, section (0 = none), blob offset, blob length
+KINDS = (ARTICLE, AMENDMENT)
+
+
+def source_revision(*htmls):
+    digest = hashlib.sha1()
+    for html in htmls:
+        digest.update(hashlib.sha1(html.encode('utf8')).digest())
+    return digest.hexdigest()
+
+
+def build_corpus(constitution_html, amendments_html):
+    passages = build_article_passages(constitution_html)
+    passages.update(build_amendment_passages(amendments_html))
+
+    table = []
+    blob = bytearray()
+
+    def order(key):
+        return KINDS.index(key[0]), key[1], key[2] or 0
+
+    for kind, number, section in sorted(passages, key=order):
+        text = passages[(kind, number, section)].encode('utf8')
+        table.append(ENTRY.pack(KINDS.index(kind), number, section or 0, len(blob), len(text)))
+        blob += text
+
+    revision = source_revision(constitution_html, amendments_html)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, revision.encode('ascii'), len(table))
+    return header + b''.join(table) + bytes(blob), passages
+
+
+class Corpus:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, revision, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._map.close()
+            raise ValueError('{} is not a version {} corpus file'.format(path, FORMAT_VERSION))
+
+        self.revision = revision.decode('ascii')
+        blob_start = HEADER.size + count * ENTRY.size
+        self._offsets = {}
+        for i in range(count):
+            kind, number, section, offset, length = ENTRY.unpack_from(
+                self._map, HEADER.size + i * ENTRY.size)
+            self._offsets[(KINDS[kind], number, section or None)] = (blob_start + offset, length)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def lookup(self, key):
+        offset, length = self._offsets[key]
+        return self._map[offset:offset + length].decode('utf8')
+
+    def close(self):
+        self._map.close()
+
+
+_corpus = None
+_corpus_loaded = False
+_corpus_checked = 0.0
+
+
+def load_corpus(path=CORPUS_PATH):
+    global _corpus, _corpus_loaded, _corpus_checked
+    _corpus_loaded = True
+    _corpus_checked = time.monotonic()
+    try:
+        _corpus = Corpus(path)
+    except (OSError, ValueError) as e:
+        logging.info('No passage corpus loaded ({}), falling back to WikiSource'.format(e))
+        _corpus = None
+    else:
+        logging.info('Loaded passage corpus {} ({} passages, revision {})'.format(
+            path, len(_corpus), _corpus.revision[:8]))
+    return _corpus
+
+
+def get_corpus():
+    if not _corpus_loaded:
+        load_corpus()
+    elif _corpus is not None and time.monotonic() - _corpus_checked >= CORPUS_CHECK:
+        reload_corpus()
+    return _corpus
+
+
+def read_revision(path):
+    # the source revision in a corpus file's header, without mapping the file
+    try:
+        with open(path, 'rb') as f:
+            magic, version, revision, _ = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None
+    return revision.decode('ascii')
+
+
+def reload_corpus():
+    # picks up the corpus file once another worker has rewritten it, so every worker switches
+    # to a new revision within CORPUS_CHECK seconds. Returns whether it did
+    global _corpus, _corpus_checked
+    _corpus_checked = time.monotonic()
+    current = _corpus
+    if current is None:
+        return False
+    revision = read_revision(current.path)
+    if revision is None or revision == current.revision:
+        return False
+    try:
+        corpus = Corpus(current.path)
+    except (OSError, ValueError) as e:
+        logging.warning('Could not reload passage corpus {}: {}'.format(current.path, e))
+        return False
+    _corpus = corpus  # lookups already holding the old one finish on its mapping
+    logging.info('Reloaded passage corpus {} (revision {})'.format(current.path,
+                                                                   corpus.revision[:8]))
+    return True
+
+
+def write_corpus(path, data):
+    # a temporary file per process and thread, so workers rewriting it at once can't clobber
+    # each other's before the rename
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def refresh_corpus(constitution_html, amendments_html):
+    # brings the loaded corpus up to date with the sources and swaps it in: only rebuilds the
+    # file if no other worker has already written this revision. Returns whether anything
+    # changed
+    current = get_corpus()
+    revision = source_revision(constitution_html, amendments_html)
+    if current is None or current.revision == revision:
+        return False
+    if read_revision(current.path) != revision:
+        data, passages = build_corpus(constitution_html, amendments_html)
+        # an error page or a markup change can parse to little or nothing; that must not
+        # replace the last good corpus. Checked per page, since either one can break
+        for kind in KINDS:
+            count = sum(1 for key in passages if key[0] == kind)
+            loaded = sum(1 for key in current.keys() if key[0] == kind)
+            if count < loaded * MIN_PASSAGE_SHARE:
+                logging.warning('Not replacing passage corpus {}: the new sources have {} {} '
+                                'passages, the loaded corpus has {}'.format(
+                                    current.path, count, kind, loaded))
+                return False
+        write_corpus(current.path, data)
+    return reload_corpus()
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Compiles the WikiSource pages into a passage corpus')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('-o', '--output', default=CORPUS_PATH, help='Corpus file to write')
+    parser.add_argument('--constitution', metavar='HTML_FILE',
+                        help='Saved constitution page (fetched from WikiSource if omitted)')
+    parser.add_argument('--amendments', metavar='HTML_FILE',
+                        help='Saved Bill of Rights page (fetched from WikiSource if omitted)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+    def read_source(path, url):
+        if path:
+            with open(path, encoding='utf8') as f:
+                return f.read()
+        from source_cache import fetch_page
+        return fetch_page(url).body
+
+    data, passages = build_corpus(read_source(args.constitution, CONSTITUTION_URL),
+                                  read_source(args.amendments, AMENDMENTS_URL))
+
+    write_corpus(args.output, data)
+
+    sections = sum(1 for kind, _, _ in passages if kind == ARTICLE)
+    amendments = sorted(number for kind, number, _ in passages if kind == AMENDMENT)
+    missing = [n for n in range(1, AMENDMENT_COUNT + 1) if n not in amendments]
+    logging.info('Wrote {} ({} bytes): {} article sections, {} amendments'.format(
+        args.output, len(data), sections, len(amendments)))
+    if missing:
+        logging.warning('Amendments missing from the sources: {}'.format(
+            ', '.join(str(n) for n in missing)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import re
+
+from passage_index import AMENDMENT, arabic_to_roman, passage_title
+from search_index import passage_body
+from telegram import InlineQueryResultArticle, InputTextMessageContent, constants
+
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 24 * 60 * 60))  # seconds
+MAX_RESULTS = 50  # Telegram's limit per answerInlineQuery
+DESCRIPTION_LENGTH = 100
+
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9:]+')
+
+
+def normalize(query):
+    return NON_ALPHANUMERIC.sub(' ', query.lower()).strip()
+
+
+def reference_aliases(key):
+    kind, number, section = key
+    if kind == AMENDMENT:
+        return ['amd{}'.format(number), 'amd {}'.format(number),
+                'amendment {}'.format(number), '{} amendment'.format(number)]
+
+    roman = arabic_to_roman(number).lower()
+    if section is None:
+        return [str(number), 'article {}'.format(number), 'article {}'.format(roman)]
+    return ['{}:{}'.format(number, section), '{}:{}'.format(roman, section),
+            'article {} section {}'.format(number, section),
+            'article {} section {}'.format(roman, section)]
+
+
+def result_id(key):
+    kind, number, section = key
+    if kind == AMENDMENT:
+        return 'amd{}'.format(number)
+    return 'a{}'.format(number) if section is None else 'a{}-s{}'.format(number, section)
+
+
+class TrieNode:
+    __slots__ = ('children', 'results')
+
+    def __init__(self):
+        self.children = {}
+        self.results = []
+
+
+class InlineIndex:
+    def __init__(self, passages):
+        self.root = TrieNode()
+        self.results = []
+        self.positions = {}
+
+        for key in sorted(passages, key=lambda k: (k[0] == AMENDMENT, k[1], k[2] or 0)):
+            body = ' '.join(passage_body(passages[key]).split())
+            if len(body) > DESCRIPTION_LENGTH:
+                body = body[:DESCRIPTION_LENGTH - 3] + '...'
+            text = passages[key][:constants.MessageLimit.MAX_TEXT_LENGTH]
+            content = InputTextMessageContent(text, parse_mode=constants.ParseMode.MARKDOWN)
+            result = InlineQueryResultArticle(result_id(key), passage_title(key), content,
+                                              description=body)
+            self.positions[key] = len(self.results)
+            self.results.append(result)
+
+            for alias in reference_aliases(key) + [normalize(passage_title(key))]:
+                self._insert(alias, result)
+
+    def _insert(self, alias, result):
+        node = self.root
+        for char in alias:
+            node = node.children.setdefault(char, TrieNode())
+            # every node keeps its finished answer so a lookup is just a walk down the trie;
+            # aliases of one passage are inserted back to back, so duplicates are adjacent
+            if len(node.results) < MAX_RESULTS and node.results[-1:] != [result]:
+                node.results.append(result)
+
+    def lookup(self, query):
+        query = normalize(query)
+        if not query:
+            return self.results[:MAX_RESULTS]
+
+        node = self.root
+        for char in query:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return node.results
+
+    def results_for(self, keys):
+        return [self.results[self.positions[key]] for key in keys if key in self.positions]
@@ -0,0 +1,78 @@
+# the old webhook-era admin pages, kept out of constitutionbot so importing the bot doesn't pull
+# in http.server
+import asyncio
+import json
+import logging
+
+from constitutionbot import (LOG_ERROR_QUERY, LOG_USER_DELETED, LOG_USER_MIGRATED,
+                             LOG_USER_REACHABLE, LOG_USER_UNREACHABLE, RECOGNIZED_ERROR_MIGRATE,
+                             RECOGNIZED_ERRORS, get_user, restricted, send_promo, telegram_query)
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+
+
+@restricted
+class MigratePage(BaseHTTPRequestHandler):
+    def get(self):
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(bytes('Migrate page\n', 'utf-8'))
+
+
+@restricted
+class PromoPage(BaseHTTPRequestHandler):
+    # @staticmethod
+    # def get():
+    #     taskqueue.add(url='/promo')
+
+    def post(self):
+        params = json.loads(self.request.body)
+        data = params.get('data')
+        uid = str(json.loads(data).get('chat_id'))
+        user = get_user(uid)
+        asyncio.run(send_promo(user))
+
+
+@restricted
+class VerifyPage(BaseHTTPRequestHandler):
+    def get(self):
+        try:
+            # query = User.all()
+            # for user in query.run(batch_size=3000):
+            # uid = str(user.get_uid())
+            # taskqueue.add(url='/verify', payload=uid)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(bytes('Cleanup in progress\n', 'utf-8'))
+        except Exception as e:
+            logging.error(e)
+
+    def post(self):
+        uid = self.request.body
+        user = get_user(uid)
+        result = {}
+        try:
+            result = asyncio.run(telegram_query(uid, 30))
+        except Exception as e:
+            logging.warning(LOG_ERROR_QUERY.format(uid, user.get_description(), str(e)))
+            self.send_error(HTTPStatus.BAD_GATEWAY)  # 502
+
+        response = json.loads(result.content)
+
+        if response.get('ok'):
+            logging.info(LOG_USER_REACHABLE.format(uid, user.get_description()))
+        else:
+            error_description = str(response.get('description'))
+            if error_description == RECOGNIZED_ERROR_MIGRATE:
+                new_uid = response.get('parameters', {}).get('migrate_to_chat_id')
+                if new_uid:
+                    user = user.migrate_to(new_uid)
+                    logging.info(LOG_USER_MIGRATED.format(uid, new_uid, user.get_description()))
+            elif error_description in RECOGNIZED_ERRORS:
+                user_description = user.get_description()
+                user.delete()
+                logging.info(LOG_USER_DELETED.format(uid, user_description))
+            else:
+                logging.warning(LOG_USER_UNREACHABLE.format(uid, user.get_description(),
+                                                            error_description))
+                self.send_error(HTTPStatus.BAD_GATEWAY)  # 502
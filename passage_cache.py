@@ -0,0 +1,228 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# '' leaves it off; otherwise a SQLite file, or redis://host:port/db for a Redis-compatible server
+PASSAGE_CACHE = os.environ.get('PASSAGE_CACHE', '')
+PASSAGE_CACHE_CHECK = float(os.environ.get('PASSAGE_CACHE_CHECK', 2))  # seconds
+REDIS_PREFIX = 'constitutionbot'
+REDIS_OLD_REVISION_TTL = 60 * 60  # seconds a superseded revision stays readable
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS revisions (
+    url TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    previous TEXT,
+    published REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS passages (
+    version TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    section INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (version, kind, number, section)
+) WITHOUT ROWID;
+'''
+
+
+class SqliteBackend:
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                     timeout=10)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def current(self, url):
+        with self._lock:
+            row = self._conn.execute('SELECT version FROM revisions WHERE url = ?',
+                                     (url,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, version, key):
+        kind, number, section = key
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT text FROM passages WHERE version = ? AND kind = ? AND number = ? '
+                'AND section = ?', (version, kind, number, section or 0)).fetchone()
+        return row[0] if row else None
+
+    def publish(self, url, version, passages):
+        rows = [(version, kind, number, section or 0, text)
+                for (kind, number, section), text in passages.items()]
+        with self._lock:
+            # one transaction: readers see either the old revision or all of the new one
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany('INSERT OR REPLACE INTO passages VALUES (?, ?, ?, ?, ?)',
+                                       rows)
+                row = self._conn.execute('SELECT version FROM revisions WHERE url = ?',
+                                         (url,)).fetchone()
+                previous = row[0] if row and row[0] != version else None
+                self._conn.execute('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?)',
+                                   (url, version, previous, time.time()))
+                # keep the previous revision for workers that haven't switched yet
+                self._conn.execute(
+                    'DELETE FROM passages WHERE version NOT IN (SELECT version FROM revisions '
+                    'UNION SELECT previous FROM revisions WHERE previous IS NOT NULL)')
+                self._conn.execute('COMMIT')
+            except sqlite3.Error:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisBackend:
+    # works with anything speaking the Redis protocol (Redis, Valkey, KeyDB...) through the
+    # optional redis package
+    def __init__(self, url, prefix=REDIS_PREFIX):
+        import redis
+
+        self.url = url
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    def _passages_key(self, version):
+        return '{}:passages:{}'.format(self.prefix, version)
+
+    def current(self, url):
+        return self._client.hget(self.prefix + ':revisions', url)
+
+    def get(self, version, key):
+        kind, number, section = key
+        return self._client.hget(self._passages_key(version),
+                                 '{}:{}:{}'.format(kind, number, section or 0))
+
+    def publish(self, url, version, passages):
+        previous = self.current(url)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.hset(self._passages_key(version), mapping={
+            '{}:{}:{}'.format(kind, number, section or 0): text
+            for (kind, number, section), text in passages.items()})
+        pipe.persist(self._passages_key(version))
+        pipe.hset(self.prefix + ':revisions', url, version)
+        if previous is not None and previous != version:
+            pipe.expire(self._passages_key(previous), REDIS_OLD_REVISION_TTL)
+        pipe.execute()
+
+    def close(self):
+        self._client.close()
+
+
+class PassageCache:
+    # passages shared by every worker on the host, keyed by the source page version they were
+    # parsed from. A worker publishes a page's passages before pointing the page's current
+    # revision at them, and the others pick up the new revision within check_interval
+    def __init__(self, backend, check_interval=PASSAGE_CACHE_CHECK):
+        self.backend = backend
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.publishes = 0
+        self._revisions = {}  # url -> (version, checked at)
+        self._local = {}  # (version, key) -> text; versioned, so it never goes stale
+        self._lock = threading.Lock()
+
+    def revision(self, url):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._revisions.get(url)
+        if cached is not None and now - cached[1] < self.check_interval:
+            return cached[0]
+
+        version = self.backend.current(url)
+        with self._lock:
+            if cached is not None and cached[0] != version:
+                logging.info('Switched {} to passage revision {}'.format(url, str(version)[:8]))
+                self._drop_local(cached[0])
+            self._revisions[url] = (version, now)
+        return version
+
+    def lookup(self, url, key):
+        # returns (version, text): no version when nothing is published for the page yet (or
+        # the backend is unreachable), no text when the page has no such passage
+        try:
+            version = self.revision(url)
+            text = None
+            if version is not None:
+                text = self._local.get((version, key))
+                if text is None:
+                    text = self.backend.get(version, key)
+        except Exception as e:
+            logging.warning('Error reading shared passage cache: {}'.format(e))
+            version = None
+        with self._lock:
+            if version is None:
+                self.misses += 1
+                return None, None
+            self.hits += 1
+            if text is not None:
+                self._local[(version, key)] = text
+        return version, text
+
+    def publish(self, url, version, passages):
+        if not passages:
+            return  # a page that parsed to nothing must not replace a good revision
+        try:
+            if self.revision(url) == version:
+                return
+            self.backend.publish(url, version, passages)
+        except Exception as e:
+            logging.warning('Error publishing to shared passage cache: {}'.format(e))
+            return
+        with self._lock:
+            self.publishes += 1
+            previous = self._revisions.get(url)
+            if previous is not None:
+                self._drop_local(previous[0])
+            self._revisions[url] = (version, time.monotonic())
+        logging.info('Published {} passages from {} as revision {}'.format(
+            len(passages), url, version[:8]))
+
+    def _drop_local(self, version):
+        for local_key in [k for k in self._local if k[0] == version]:
+            del self._local[local_key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'publishes': self.publishes,
+                    'local': len(self._local)}
+
+    def close(self):
+        self.backend.close()
+
+
+def open_backend(location):
+    if location.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(location)
+    return SqliteBackend(location)
+
+
+_cache = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
+
+
+def get_passage_cache():
+    global _cache, _cache_loaded
+    with _cache_lock:
+        if not _cache_loaded:
+            _cache_loaded = True
+            if PASSAGE_CACHE:
+                try:
+                    _cache = PassageCache(open_backend(PASSAGE_CACHE))
+                except Exception as e:
+                    logging.warning('No shared passage cache ({}): {}'.format(PASSAGE_CACHE, e))
+                else:
+                    atexit.register(_cache.close)
+                    logging.info('Sharing passages through ' + PASSAGE_CACHE)
+    return _cache
@@ -0,0 +1,185 @@
+import logging
+import metrics
+import re
+import threading
+
+PARSE_SECONDS = metrics.histogram('constitutionbot_parse_seconds',
+                                  'Time spent parsing WikiSource pages with BeautifulSoup',
+                                  ('page',))
+
+ARTICLE = 'article'
+AMENDMENT = 'amendment'
+
+# adjusted to account for two original amendments at the beginning
+AMENDMENT_ORDINALS = ['third', 'fourth', 'fifth', 'sixth', 'seventh', 'eighth', 'ninth', 'tenth',
+                      'eleventh', 'twelfth']
+
+# format of html element ids: aIV[-s#][-c#]
+ARTICLE_ID = re.compile(r'^a([IVX]+)(?:-s(\d+))?(?:-|$)')
+REFERENCE = re.compile(r'(\d{1,3})(?::(\d{1,3}))?')  # <article>[:<section>] or <amendment>
+ROMAN_NUMERALS = ((1000, 'M'), (900, 'CM'), (500, 'D'), (400, 'CD'), (100, 'C'), (90, 'XC'),
+                  (50, 'L'), (40, 'XL'), (10, 'X'), (9, 'IX'), (5, 'V'), (4, 'IV'), (1, 'I'))
+MARKDOWN_CHARS = re.compile(r'([*_`\[])')
+WANTED = 'bg-bot-passage-text'
+
+
+def strip_markdown(string):
+    return string.replace('*', r'\*').replace('_', r'\_').replace('`', r'\`').replace('[', r'\[')
+
+
+def arabic_to_roman(numeral):
+    if numeral < 1:
+        return str(numeral)  # no roman numeral for it
+    roman = ''
+    for value, letters in ROMAN_NUMERALS:
+        count, numeral = divmod(numeral, value)
+        roman += letters * count
+    return roman
+
+
+def roman_to_arabic(numeral):
+    roman = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII']
+    return roman.index(numeral) + 1
+
+
+def passage_key(reference, is_amendment=False):
+    # only checks the form; references.py checks that the passage exists
+    match = REFERENCE.fullmatch(reference.strip())
+    if match is None:
+        raise ValueError('Not a passage reference: ' + repr(reference))
+    number, section = match.group(1), match.group(2)
+    if is_amendment:
+        if section is not None:
+            raise ValueError('Amendments have no sections: ' + repr(reference))
+        return AMENDMENT, int(number), None
+    return ARTICLE, int(number), int(section) if section else None
+
+
+def passage_title(key):
+    kind, number, section = key
+    if kind == AMENDMENT:
+        return 'Amendment {}'.format(number)
+    if section is None:
+        return 'Article {}'.format(arabic_to_roman(number))
+    return 'Article {} Section {}'.format(arabic_to_roman(number), section)
+
+
+def format_passage(key, texts):
+    final_text = '*' + strip_markdown(passage_title(key)) + '*\n\n'
+    for text in texts:
+        final_text += text + '\n\n'
+    return final_text.strip()
+
+
+def _render(soup, tags):
+    needed_stripping = False
+    for tag in tags:
+        tag['class'] = WANTED
+        for bad_string in tag(string=MARKDOWN_CHARS):
+            bad_string.replace_with(strip_markdown(bad_string))
+            needed_stripping = True
+
+    if needed_stripping:
+        logging.debug('Stripped markdown')
+
+    for tag in soup.select('br'):
+        tag.name = 'span'
+        tag.string = '\n'
+
+    for tag in soup.select('.text'):
+        tag.string = tag.text.rstrip()
+
+    return [tag.text.strip() for tag in tags]
+
+
+def build_article_passages(html):
+    # bs4 is only needed once a page has to be parsed, not when serving from the corpus
+    from bs4 import BeautifulSoup
+
+    # not sure if consistent/good
+    start = html.find('<div class="prp-pages-output')
+    end = html.find('<table>', start)
+    soup = BeautifulSoup(html[start:end], 'html.parser')
+
+    keys = []
+    tags = []
+    for tag in soup.find_all(id=ARTICLE_ID):
+        # nested ids (aI-s2 > aI-s2-c1) are already covered by the outer tag
+        if any(parent.get('class') == WANTED for parent in tag.parents):
+            continue
+        match = ARTICLE_ID.match(tag['id'])
+        section = int(match.group(2)) if match.group(2) else None
+        keys.append((ARTICLE, roman_to_arabic(match.group(1)), section))
+        tags.append(tag)
+        tag['class'] = WANTED
+
+    grouped = {}
+    for key, text in zip(keys, _render(soup, tags)):
+        grouped.setdefault(key, []).append(text)
+
+    # a bare article id is only a passage when that article has no sections
+    sectioned = set(number for _, number, section in grouped if section is not None)
+    return dict((key, format_passage(key, texts)) for key, texts in grouped.items()
+                if key[2] is not None or key[1] not in sectioned)
+
+
+def build_amendment_passages(html):
+    from bs4 import BeautifulSoup
+
+    passages = {}
+    for number, ordinal in enumerate(AMENDMENT_ORDINALS, 1):
+        start = html.find('Article the {}'.format(ordinal))
+        if start == -1:
+            continue
+        end = html.find('</tr>', start)
+        soup = BeautifulSoup(html[start:end], 'html.parser')
+        key = (AMENDMENT, number, None)
+        passages[key] = format_passage(key, _render(soup, soup.select('td')))
+    return passages
+
+
+class PassageIndex:
+    def __init__(self, version, passages):
+        self.version = version
+        self.passages = passages
+
+    def lookup(self, key):
+        passage = self.passages.get(key)
+        if passage is None:
+            return format_passage(key, [])
+        return passage
+
+
+_indexes = {}
+_build_lock = threading.Lock()
+
+
+def get_index(page, is_amendment=False, wait=False):
+    index = _indexes.get(page.url)
+    if index is not None and index.version == page.version:
+        return index
+
+    # while a newer version is being parsed, keep answering from the one we have unless told
+    # to wait for it
+    if not _build_lock.acquire(blocking=wait or index is None):
+        return index
+    try:
+        index = _indexes.get(page.url)
+        if index is None or index.version != page.version:
+            logging.debug('Began BeautifulSoup processing')
+            with PARSE_SECONDS.time(AMENDMENT if is_amendment else ARTICLE):
+                if is_amendment:
+                    passages = build_amendment_passages(page.body)
+                else:
+                    passages = build_article_passages(page.body)
+            index = PassageIndex(page.version, passages)
+            _indexes[page.url] = index  # swapped in whole; readers get the old or the new one
+            logging.debug('Finished BeautifulSoup processing')
+    finally:
+        _build_lock.release()
+    return index
+
+
+def clear_indexes():
+    with _build_lock:
+        _indexes.clear()
@@ -0,0 +1,131 @@
+import cProfile
+import heapq
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import time
+import tracemalloc
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 0.1))  # share of updates sampled
+PROFILE_SLOWEST = int(os.environ.get('PROFILE_SLOWEST', 10))
+PROFILE_DUMP_INTERVAL = 60  # seconds between writing profiles out
+STACK_LINES = 20
+ALLOCATION_LINES = 25
+
+
+def describe(update):
+    message = getattr(update, 'effective_message', None)
+    inline_query = getattr(update, 'inline_query', None)
+    if inline_query is not None:
+        text = 'inline ' + inline_query.query
+    elif message is not None:
+        text = message.text or ''
+    else:
+        text = ''
+    chat = getattr(update, 'effective_chat', None)
+    return '{} {!r}'.format(chat.id if chat is not None else '-', text[:60])
+
+
+def command_filename(command):
+    return re.sub(r'[^A-Za-z0-9_]+', '', command) or 'update'
+
+
+class HandlerProfiler:
+    # samples a share of handler runs with cProfile, and optionally tracemalloc, one at a time.
+    # cProfile only sees the event loop thread, so time in blocking.run_blocking shows up as
+    # the await on it, and anything other tasks run meanwhile is counted too
+    def __init__(self, directory=PROFILE_DIR, rate=PROFILE_RATE, slowest=PROFILE_SLOWEST,
+                 trace_memory=False):
+        self.directory = directory
+        self.rate = rate
+        self.slowest = slowest
+        self.trace_memory = trace_memory
+
+        self.sampled = 0
+        self._active = False
+        self._stats = {}  # command -> pstats.Stats
+        self._allocations = {}  # command -> {(filename, lineno): [size, count]}
+        self._slowest = []  # min-heap of (seconds, sample number, command, description, stack)
+        self._last_dump = time.monotonic()
+
+    async def run(self, command, coroutine, update=None):
+        if self._active or random.random() >= self.rate:
+            return await coroutine
+
+        self._active = True
+        profile = cProfile.Profile()
+        # leave tracing alone if something else, like -X tracemalloc, already started it
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            return await coroutine
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            snapshot = None
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+            if tracing:
+                tracemalloc.stop()
+            self._active = False
+            self._record(command, profile, snapshot, elapsed, update)
+
+    def _record(self, command, profile, snapshot, elapsed, update):
+        self.sampled += 1
+        if command in self._stats:
+            self._stats[command].add(profile)
+        else:
+            self._stats[command] = pstats.Stats(profile)
+
+        if snapshot is not None:
+            lines = self._allocations.setdefault(command, {})
+            for stat in snapshot.statistics('lineno'):
+                frame = stat.traceback[0]
+                line = lines.setdefault((frame.filename, frame.lineno), [0, 0])
+                line[0] += stat.size
+                line[1] += stat.count
+
+        # the stack breakdown is only formatted for runs that make the slowest list
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, (elapsed, self.sampled, command, describe(update),
+                                           format_stack(profile)))
+        elif self._slowest and elapsed > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (elapsed, self.sampled, command, describe(update),
+                                              format_stack(profile)))
+
+        if time.monotonic() - self._last_dump >= PROFILE_DUMP_INTERVAL:
+            self.dump()
+
+    def dump(self):
+        self._last_dump = time.monotonic()
+        if not self.sampled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for command, stats in self._stats.items():
+            stats.dump_stats(os.path.join(self.directory, command_filename(command) + '.prof'))
+        for command, lines in self._allocations.items():
+            path = os.path.join(self.directory, command_filename(command) + '.alloc.txt')
+            with open(path, 'w', encoding='utf8') as f:
+                top = sorted(lines.items(), key=lambda item: item[1][0], reverse=True)
+                for (filename, lineno), (size, count) in top[:ALLOCATION_LINES]:
+                    f.write('{:>12} B {:>8} blocks  {}:{}\n'.format(size, count, filename, lineno))
+        with open(os.path.join(self.directory, 'slowest.txt'), 'w', encoding='utf8') as f:
+            for elapsed, _, command, description, stack in sorted(self._slowest, reverse=True):
+                f.write('{:.1f} ms  {}  {}\n{}\n'.format(elapsed * 1000, command, description,
+                                                         stack))
+        logging.info('Wrote {} profiled updates to {}'.format(self.sampled, self.directory))
+
+
+def format_stack(profile):
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(STACK_LINES)
+    # drop the header pstats prints above the table
+    text = out.getvalue()
+    return text[text.find('   ncalls'):] if '   ncalls' in text else text
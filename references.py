@@ -0,0 +1,153 @@
+import re
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from passage_index import AMENDMENT, AMENDMENT_ORDINALS, ARTICLE, REFERENCE, arabic_to_roman
+
+LIST_SEPARATOR = ','
+RANGE_SEPARATOR = '-'
+SECTION_SEPARATOR = ':'
+KINDS = (ARTICLE, AMENDMENT)
+LAST_SECTION = float('inf')
+MAX_REJECTED = 1024  # rejected queries remembered
+
+# every passage there is: sections per article (0 = no sections), and the amendments on the
+# Bill of Rights page
+ARTICLE_SECTIONS = {1: 10, 2: 4, 3: 3, 4: 4, 5: 0, 6: 0, 7: 0}
+AMENDMENT_COUNT = len(AMENDMENT_ORDINALS)
+
+# <reference>[-<reference>], where the end of a section range can leave out the article
+ITEM = re.compile(r'{0}(?:{1}{0})?'.format(REFERENCE.pattern, RANGE_SEPARATOR))
+
+EXAMPLES = 'e.g. /get 3:2, /get 1:8-1:10,2:1 or /getAmd 1-10'
+NO_REFERENCE = 'Which passage do you want to look up? Try ' + EXAMPLES
+NOT_A_REFERENCE = '"{}" isn\'t a passage reference. Try ' + EXAMPLES
+NO_ARTICLE = 'There is no Article {}; the Constitution has Articles 1 to {}.'
+NO_SECTION = 'Article {} only has Sections 1 to {}.'
+NO_SECTIONS = 'Article {} has no sections, try /get {}'
+PICK_SECTION = 'Article {0} has Sections 1 to {1}, e.g. /get {2}:1 or /get {2}:1-{1}'
+NO_AMENDMENT = 'I can only look up Amendments 1 to {}.'
+AMENDMENT_SECTIONS = 'Amendments have no sections, try /getAmd {}'
+BACKWARDS = 'The range {} runs backwards, try {}'
+
+
+class InvalidReference(ValueError):
+    # the message is meant for the user
+    pass
+
+
+def passage_order(key):
+    # reading order: the articles and their sections, then the amendments
+    kind, number, section = key
+    return KINDS.index(kind), number, section or 0
+
+
+def check_key(key, in_range=False):
+    # raises InvalidReference unless the passage exists; a whole article that has sections is
+    # only allowed as the end of a range
+    kind, number, section = key
+    if kind == AMENDMENT:
+        if not 1 <= number <= AMENDMENT_COUNT:
+            raise InvalidReference(NO_AMENDMENT.format(AMENDMENT_COUNT))
+        return
+
+    sections = ARTICLE_SECTIONS.get(number)
+    if sections is None:
+        raise InvalidReference(NO_ARTICLE.format(number, len(ARTICLE_SECTIONS)))
+    roman = arabic_to_roman(number)
+    if section is None:
+        if sections and not in_range:
+            raise InvalidReference(PICK_SECTION.format(roman, sections, number))
+    elif not sections:
+        raise InvalidReference(NO_SECTIONS.format(roman, number))
+    elif not 1 <= section <= sections:
+        raise InvalidReference(NO_SECTION.format(roman, sections))
+
+
+def reference_text(key):
+    kind, number, section = key
+    return str(number) if section is None else '{}{}{}'.format(number, SECTION_SEPARATOR, section)
+
+
+def parse_item(part, is_amendment=False):
+    match = ITEM.fullmatch(part)
+    if match is None:
+        raise InvalidReference(NOT_A_REFERENCE.format(part))
+    first, first_section, last, last_section = match.groups()
+    if is_amendment and (first_section or last_section):
+        raise InvalidReference(AMENDMENT_SECTIONS.format(first))
+    if first_section is not None and last is not None and last_section is None:
+        last, last_section = first, last  # 1:8-10 is short for 1:8-1:10
+
+    kind = AMENDMENT if is_amendment else ARTICLE
+    first_key = (kind, int(first), int(first_section) if first_section else None)
+    if last is None:
+        check_key(first_key)
+        return first_key, None
+
+    last_key = (kind, int(last), int(last_section) if last_section else None)
+    check_key(first_key, in_range=True)
+    check_key(last_key, in_range=True)
+    high = passage_order(last_key)
+    if last_key[2] is None:
+        high = high[:2] + (LAST_SECTION,)
+    if passage_order(first_key) > high:
+        raise InvalidReference(BACKWARDS.format(part, RANGE_SEPARATOR.join(
+            [reference_text(last_key), reference_text(first_key)])))
+    return first_key, last_key
+
+
+def parse_references(text, is_amendment=False):
+    # '1:8-1:10,2:1' -> [(first key, last key), ...], where a single reference has no last key.
+    # Raises InvalidReference, before anything is fetched, unless every passage exists
+    text = ''.join(text.split())
+    if not text:
+        raise InvalidReference(NO_REFERENCE)
+    return [parse_item(part, is_amendment) for part in text.split(LIST_SEPARATOR)]
+
+
+def resolve_references(references, keys):
+    # expands the ranges over the passages in keys, in reading order; a range ending on a bare
+    # article runs to its last section. Single references are kept as they are, and each
+    # passage is listed once
+    ordered = sorted((passage_order(key), key) for key in keys)
+    orders = [order for order, _ in ordered]
+
+    resolved = []
+    for first, last in references:
+        if last is None:
+            resolved.append(first)
+            continue
+        high = passage_order(last)
+        if last[2] is None:
+            high = high[:2] + (LAST_SECTION,)
+        start = bisect_left(orders, passage_order(first))
+        resolved.extend(key for _, key in ordered[start:bisect_right(orders, high, start)])
+    return list(dict.fromkeys(resolved))
+
+
+class ReferenceParser:
+    # parse_references with a negative cache: a query that was rejected recently is rejected
+    # again straight from the cache
+    def __init__(self, max_rejected=MAX_REJECTED):
+        self.max_rejected = max_rejected
+        self.hits = 0
+        self.rejected = 0
+        self._rejected = OrderedDict()  # (query, is_amendment) -> message
+
+    def parse(self, text, is_amendment=False):
+        query = (''.join(text.split()), is_amendment)
+        message = self._rejected.get(query)
+        if message is not None:
+            self._rejected.move_to_end(query)
+            self.hits += 1
+            raise InvalidReference(message)
+
+        try:
+            return parse_references(text, is_amendment)
+        except InvalidReference as e:
+            self.rejected += 1
+            self._rejected[query] = str(e)
+            if len(self._rejected) > self.max_rejected:
+                self._rejected.popitem(last=False)
+            raise
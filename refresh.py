@@ -0,0 +1,58 @@
+import logging
+import os
+import random
+import threading
+import time
+
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 60 * 60))  # seconds, 0 = off
+REFRESH_JITTER = 0.1  # share of the interval, so workers don't all refresh at once
+
+
+class Refresher:
+    # calls refresh every interval on a background thread. Failures are logged and retried on
+    # the next run; whatever refresh serves from keeps serving meanwhile
+    def __init__(self, refresh, interval=REFRESH_INTERVAL, jitter=REFRESH_JITTER):
+        self.refresh = refresh
+        self.interval = interval
+        self.jitter = jitter
+        self.runs = 0
+        self.failures = 0
+        self.changes = 0
+        self.last_success = None  # time.time() of the last run that reached upstream
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='refresh', daemon=True)
+        self._thread.start()
+        logging.info('Refreshing sources every {:.0f} seconds'.format(self.interval))
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval * (1 + random.uniform(0, self.jitter))):
+            self.run_once()
+
+    def run_once(self):
+        start = time.perf_counter()
+        self.runs += 1
+        try:
+            changed = self.refresh()
+        except Exception as e:
+            self.failures += 1
+            logging.warning('Error refreshing sources, keeping the last good copy:\n' + str(e))
+            return False
+        self.last_success = time.time()
+        if changed:
+            self.changes += 1
+        logging.info('Refreshed sources in {:.0f} ms ({})'.format(
+            (time.perf_counter() - start) * 1000, 'changed' if changed else 'unchanged'))
+        return changed
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {'runs': self.runs, 'failures': self.failures, 'changes': self.changes,
+                'last_success': self.last_success}
@@ -0,0 +1,131 @@
+import bisect
+import math
+import re
+
+from passage_index import passage_title
+
+TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+ESCAPED_MARKDOWN = re.compile(r'\\([*_`\[])')
+
+SNIPPET_BEFORE = 60
+SNIPPET_AFTER = 140
+
+# BM25 tuning
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    return [(m.group(), m.start(), m.end()) for m in TOKEN.finditer(text.lower())]
+
+
+def passage_body(passage):
+    # drop the bold title line and undo the markdown escaping
+    _, _, body = passage.partition('\n\n')
+    return ESCAPED_MARKDOWN.sub(r'\1', body)
+
+
+class SearchIndex:
+    def __init__(self, passages):
+        self.keys = []
+        self.bodies = []
+        self.spans = []
+        self.postings = {}
+
+        for doc_id, key in enumerate(sorted(passages, key=lambda k: (k[0], k[1], k[2] or 0))):
+            body = passage_body(passages[key])
+            tokens = tokenize(body)
+            self.keys.append(key)
+            self.bodies.append(body)
+            self.spans.append([(start, end) for _, start, end in tokens])
+            for position, (term, _, _) in enumerate(tokens):
+                self.postings.setdefault(term, {}).setdefault(doc_id, []).append(position)
+
+        self.terms = sorted(self.postings)
+        self.average_length = sum(len(s) for s in self.spans) / max(len(self.spans), 1)
+
+    def _expand(self, prefix):
+        i = bisect.bisect_left(self.terms, prefix)
+        while i < len(self.terms) and self.terms[i].startswith(prefix):
+            yield self.terms[i]
+            i += 1
+
+    def _phrase_matches(self, terms):
+        # doc_id -> start positions where every term follows the previous one
+        first = self.postings.get(terms[0], {})
+        matches = {}
+        for doc_id, positions in first.items():
+            starts = set(positions)
+            for offset, term in enumerate(terms[1:], 1):
+                following = self.postings.get(term, {}).get(doc_id)
+                if not following:
+                    starts = set()
+                    break
+                starts &= set(p - offset for p in following)
+            if starts:
+                matches[doc_id] = sorted(starts)
+        return matches
+
+    def _clause_matches(self, clause):
+        # every clause of a query must match; returns doc_id -> positions
+        phrase, word = clause
+        if phrase is not None:
+            terms = [term for term, _, _ in tokenize(phrase)]
+            if not terms:
+                return None
+            return self._phrase_matches(terms)
+
+        if word.endswith('*'):
+            matches = {}
+            for term in self._expand(word.rstrip('*').lower()):
+                for doc_id, positions in self.postings[term].items():
+                    matches.setdefault(doc_id, []).extend(positions)
+            return matches
+
+        terms = [term for term, _, _ in tokenize(word)]
+        if not terms:
+            return None
+        if len(terms) > 1:
+            return self._phrase_matches(terms)
+        return dict(self.postings.get(terms[0], {}))
+
+    def search(self, query, limit=5):
+        clauses = [self._clause_matches(m.groups()) for m in QUERY_PART.finditer(query)]
+        clauses = [c for c in clauses if c is not None]
+        if not clauses:
+            return []
+
+        doc_ids = set(clauses[0])
+        for clause in clauses[1:]:
+            doc_ids &= set(clause)
+
+        results = []
+        for doc_id in doc_ids:
+            length_norm = K1 * (1 - B + B * len(self.spans[doc_id]) / self.average_length)
+            score = 0.0
+            for clause in clauses:
+                frequency = len(clause[doc_id])
+                idf = math.log(1 + (len(self.keys) - len(clause) + 0.5) / (len(clause) + 0.5))
+                score += idf * frequency * (K1 + 1) / (frequency + length_norm)
+            first_hit = min(min(clause[doc_id]) for clause in clauses)
+            results.append((score, doc_id, first_hit))
+
+        results.sort(key=lambda r: (-r[0], r[1]))
+        return [(self.keys[doc_id], passage_title(self.keys[doc_id]), self.snippet(doc_id, hit))
+                for _, doc_id, hit in results[:limit]]
+
+    def snippet(self, doc_id, position):
+        body = self.bodies[doc_id]
+        start, _ = self.spans[doc_id][position]
+        left = max(0, start - SNIPPET_BEFORE)
+        right = min(len(body), start + SNIPPET_AFTER)
+        if left > 0:
+            left = body.find(' ', left) + 1
+        if right < len(body):
+            space = body.rfind(' ', start, right)
+            if space > start:
+                right = space
+
+        text = ' '.join(body[left:right].split())
+        return ('...' if left > 0 else '') + text + ('...' if right < len(body) else '')
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+import httpx
+
+# defaults follow queue.yaml: rate 20/s, bucket_size 40, max_concurrent_requests 20
+SEND_RATE = float(os.environ.get('SEND_RATE', 20))
+SEND_BUCKET_SIZE = int(os.environ.get('SEND_BUCKET_SIZE', 40))
+SEND_MAX_CONCURRENT = int(os.environ.get('SEND_MAX_CONCURRENT', 20))
+SEND_RETRY_LIMIT = 50  # task_retry_limit
+SEND_AGE_LIMIT = 3 * 24 * 60 * 60  # task_age_limit: 3d
+
+# Telegram allows about one message a second per chat and 20 a minute per group
+CHAT_RATE = 1.0
+CHAT_BUCKET_SIZE = 3
+GROUP_RATE = 20 / 60
+GROUP_BUCKET_SIZE = 5
+
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 60.0
+MAX_IDLE_CHATS = 1000
+
+LOG_RATE_LIMITED = 'Rate limited sending to uid {}, retrying in {}s'
+LOG_RETRYING = 'Retrying send to uid {} in {:.1f}s (attempt {}): {}'
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and self.paused_until <= self.updated
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                return
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatState:
+    def __init__(self, uid):
+        is_group = str(uid).startswith('-')
+        self.bucket = TokenBucket(GROUP_RATE if is_group else CHAT_RATE,
+                                  GROUP_BUCKET_SIZE if is_group else CHAT_BUCKET_SIZE)
+        self.lock = asyncio.Lock()  # FIFO, keeps a chat's messages in order
+        self.pending = 0
+
+
+class OutboundQueue:
+    def __init__(self, send, rate=SEND_RATE, bucket_size=SEND_BUCKET_SIZE,
+                 max_concurrent=SEND_MAX_CONCURRENT, retry_limit=SEND_RETRY_LIMIT,
+                 age_limit=SEND_AGE_LIMIT, bucket=None):
+        self.send = send
+        # pass another queue's bucket to share its global limit and 429 pauses
+        self.bucket = bucket if bucket is not None else TokenBucket(rate, bucket_size)
+        self.max_concurrent = max_concurrent
+        self.retry_limit = retry_limit
+        self.age_limit = age_limit
+
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+
+        self._loop = None
+        self._semaphore = None
+        self._chats = {}
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._chats = {}
+
+    def enqueue(self, uid, data):
+        self._bind_loop()
+        chat = self._chats.get(uid)
+        if chat is None:
+            chat = self._chats[uid] = ChatState(uid)
+        chat.pending += 1
+        self.pending += 1
+        return asyncio.ensure_future(self._deliver(uid, chat, data))
+
+    async def _deliver(self, uid, chat, data):
+        enqueued = time.monotonic()
+        try:
+            # the chat's lock is held throughout to keep its messages in order; the shared slots
+            # only around each request, so a chat waiting on its limits doesn't hold one
+            async with chat.lock:
+                return await self._send_with_retries(uid, chat, data, enqueued)
+        finally:
+            chat.pending -= 1
+            self.pending -= 1
+            self._prune()
+
+    async def _send_with_retries(self, uid, chat, data, enqueued):
+        attempt = 0
+        while True:
+            await chat.bucket.acquire()
+
+            error = None
+            response = None
+            try:
+                async with self._semaphore:
+                    await self.bucket.acquire()
+                    result = await self.send(data)
+                response = json.loads(result.content)
+            except (httpx.HTTPError, ValueError) as e:
+                error = e
+                status = None
+            else:
+                status = result.status_code
+
+            if response is not None and (response.get('ok') or not is_retryable(status)):
+                if response.get('ok'):
+                    self.sent += 1
+                return response
+
+            attempt += 1
+            if attempt > self.retry_limit or time.monotonic() - enqueued > self.age_limit:
+                self.failed += 1
+                if error is not None:
+                    raise error
+                return response
+
+            self.retried += 1
+            retry_after = (response or {}).get('parameters', {}).get('retry_after')
+            if retry_after:
+                # flood control applies to the whole bot, not just this chat
+                self.rate_limited += 1
+                logging.warning(LOG_RATE_LIMITED.format(uid, retry_after))
+                chat.bucket.pause(retry_after)
+                self.bucket.pause(retry_after)
+            else:
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                reason = error if error is not None else response.get('description')
+                logging.info(LOG_RETRYING.format(uid, delay, attempt, reason))
+                await asyncio.sleep(delay)
+
+    def _prune(self):
+        if len(self._chats) > MAX_IDLE_CHATS:
+            for uid, chat in list(self._chats.items()):
+                if chat.pending == 0 and chat.bucket.is_full():
+                    del self._chats[uid]
+
+    def stats(self):
+        return {'pending': self.pending, 'sent': self.sent, 'failed': self.failed,
+                'retried': self.retried, 'rate_limited': self.rate_limited,
+                'chats': len(self._chats)}
+
+
+def is_retryable(status):
+    return status is None or status == 429 or status >= 500
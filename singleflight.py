@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self):
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+
+    def do(self, key, func, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def do_async(self, key, func, *args):
+        # tasks belong to one loop, so only coalesce callers on the same loop
+        task_key = (asyncio.get_running_loop(), key)
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = asyncio.ensure_future(func(*args))
+                self._tasks[task_key] = task
+                task.add_done_callback(lambda _: self._forget(task_key))
+            else:
+                self.coalesced += 1
+
+        # one caller giving up must not cancel the lookup for everyone else
+        return await asyncio.shield(task)
+
+    def _forget(self, task_key):
+        with self._lock:
+            self._tasks.pop(task_key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'coalesced': self.coalesced,
+                    'in_flight': len(self._calls) + len(self._tasks)}
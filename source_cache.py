@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import metrics
+import time
+
+SOURCE_CACHE_DIR = os.environ.get('SOURCE_CACHE_DIR', '.source_cache')
+SOURCE_CACHE_TTL = int(os.environ.get('SOURCE_CACHE_TTL', 6 * 60 * 60))  # seconds
+FETCH_TIMEOUT = 10
+BREAKER_THRESHOLD = int(os.environ.get('SOURCE_BREAKER_THRESHOLD', 3))  # failures in a row
+BREAKER_COOLDOWN = float(os.environ.get('SOURCE_BREAKER_COOLDOWN', 5 * 60))  # seconds
+
+FETCH_SECONDS = metrics.histogram('constitutionbot_wikisource_fetch_seconds',
+                                  'Time spent fetching pages from WikiSource')
+
+
+class FetchError(Exception):
+    # wraps requests' errors so callers can catch them without importing requests
+    pass
+
+
+class CircuitBreaker:
+    # stops calling an upstream after repeated failures. After the cooldown one caller gets
+    # through to try again, and the circuit closes once a call succeeds
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                self._opened_at = time.monotonic()  # hold everyone else off while this one tries
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self._opened_at is None:
+                    self.opened += 1
+                    logging.warning('WikiSource failed {} times in a row, pausing fetches for {} '
+                                    'seconds'.format(self.failures, self.cooldown))
+                self._opened_at = time.monotonic()
+
+    def is_open(self):
+        return self._opened_at is not None
+
+
+class CachedPage:
+    def __init__(self, url, body, etag=None, last_modified=None, fetched_at=0.0):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.version = hashlib.sha1(body.encode('utf8')).hexdigest()
+
+    def is_fresh(self, ttl):
+        return time.time() - self.fetched_at < ttl
+
+
+class SourceCache:
+    def __init__(self, cache_dir=SOURCE_CACHE_DIR, ttl=SOURCE_CACHE_TTL, breaker=None):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.stale = 0
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.json', base + '.html'
+
+    def _load(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, encoding='utf8') as f:
+                meta = json.load(f)
+            with open(body_path, encoding='utf8') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return CachedPage(url, body, meta.get('etag'), meta.get('last_modified'),
+                          meta.get('fetched_at', 0.0))
+
+    def _store(self, page, body_changed=True):
+        meta_path, body_path = self._paths(page.url)
+        meta = {'url': page.url, 'etag': page.etag, 'last_modified': page.last_modified,
+                'fetched_at': page.fetched_at}
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            if body_changed:
+                _write_atomic(body_path, page.body)
+            _write_atomic(meta_path, json.dumps(meta))
+        except OSError as e:
+            logging.warning('Could not write source cache for {}: {}'.format(page.url, e))
+
+    def get_cached(self, url):
+        with self._lock:
+            page = self._pages.get(url)
+            if page is None:
+                page = self._load(url)
+                if page is not None:
+                    self._pages[url] = page
+            return page
+
+    def fetch(self, url, force=False):
+        # force skips the TTL and fails instead of falling back to a stale copy, for refreshes
+        page = self.get_cached(url)
+        if page is not None and not force and page.is_fresh(self.ttl):
+            with self._lock:
+                self.hits += 1
+            return page
+
+        headers = {}
+        if page is not None:
+            if page.etag:
+                headers['If-None-Match'] = page.etag
+            if page.last_modified:
+                headers['If-Modified-Since'] = page.last_modified
+
+        if not self.breaker.allow():
+            # the breaker logged when it opened, so no warning per request here
+            if page is not None and not force:
+                with self._lock:
+                    self.stale += 1
+                return page
+            raise FetchError('WikiSource fetches are paused after repeated failures')
+
+        # imported on first fetch, which a warm cache or a compiled corpus never gets to
+        import requests
+
+        logging.debug('Began fetching from remote')
+        try:
+            with FETCH_SECONDS.time():
+                result = requests.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+            result.raise_for_status()
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            return self._stale(page, url, str(e), force)
+        self.breaker.record_success()
+        logging.debug('Finished fetching from remote')
+
+        if result.status_code == 304 and page is not None:
+            page.fetched_at = time.time()
+            self._store(page, body_changed=False)
+            with self._lock:
+                self.hits += 1
+                self.revalidations += 1
+            return page
+
+        page = CachedPage(url, result.content.decode('utf8'), result.headers.get('ETag'),
+                          result.headers.get('Last-Modified'), time.time())
+        self._store(page)
+        with self._lock:
+            self._pages[url] = page
+            self.misses += 1
+        return page
+
+    def _stale(self, page, url, reason, force):
+        # an outdated page beats no page for users, but refreshes need to know it failed
+        if page is None or force:
+            raise FetchError(reason)
+        logging.warning('Serving stale copy of {}: {}'.format(url, reason))
+        with self._lock:
+            self.stale += 1
+        return page
+
+    def seed(self, url, body):
+        # records a page obtained elsewhere, e.g. a saved copy, as freshly fetched
+        page = CachedPage(url, body, fetched_at=time.time())
+        self._store(page)
+        with self._lock:
+            self._pages[url] = page
+        return page
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations,
+                    'stale': self.stale, 'breaker_open': self.breaker.is_open()}
+
+
+def _write_atomic(path, text):
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+default_cache = SourceCache()
+
+
+def fetch_page(url, force=False):
+    return default_cache.fetch(url, force)
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+
+from blocking import run_blocking
+from collections import Counter
+
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', 3000))
+SWEEP_CONCURRENCY = int(os.environ.get('SWEEP_CONCURRENCY', 50))
+SWEEP_CHECKPOINT = os.environ.get('SWEEP_CHECKPOINT', 'sweep.checkpoint.json')
+
+REACHABLE = 'reachable'
+MIGRATED = 'migrated'
+DELETED = 'deleted'
+UNKNOWN = 'unknown'
+
+LOG_SWEEP_PROGRESS = 'Sweep: {} checked ({}), cursor {}'
+LOG_SWEEP_PAUSED = 'Sweep paused after uid {}'
+
+
+def classify(result, recognized_errors, migrate_error):
+    # returns (status, new uid for migrations)
+    if isinstance(result, BaseException):
+        return UNKNOWN, None
+    if result.get('ok'):
+        return REACHABLE, None
+
+    description = str(result.get('description'))
+    if description == migrate_error:
+        new_uid = result.get('parameters', {}).get('migrate_to_chat_id')
+        return (MIGRATED, new_uid) if new_uid else (UNKNOWN, None)
+    if description in recognized_errors:
+        return DELETED, None
+    return UNKNOWN, None
+
+
+class SweepReport:
+    def __init__(self, saved=None):
+        self.counts = Counter(saved or {})
+
+    def checked(self):
+        return sum(self.counts.values())
+
+    def describe(self):
+        return ', '.join('{} {}'.format(count, status) for status, count in
+                         sorted(self.counts.items()))
+
+    def summary(self):
+        return 'Sweep finished: {} checked ({})'.format(self.checked(), self.describe())
+
+
+async def run_sweep(get_batch, query, apply_changes, recognized_errors, migrate_error,
+                    checkpoint, stop=None, batch_size=SWEEP_BATCH_SIZE,
+                    concurrency=SWEEP_CONCURRENCY):
+    # get_batch(after_uid, batch_size) -> users ordered by uid; query(uid) -> Bot API response;
+    # apply_changes(migrations, deletions) writes one batch to the store
+    cursor = checkpoint.get('cursor')
+    report = SweepReport(checkpoint.get('counts'))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(uid):
+        async with semaphore:
+            try:
+                result = await query(uid)
+            except Exception as e:
+                logging.warning('Error querying uid {}: {}'.format(uid, e))
+                result = e
+        return uid, classify(result, recognized_errors, migrate_error)
+
+    while stop is None or not stop.is_set():
+        batch = await run_blocking(get_batch, cursor, batch_size)
+        if not batch:
+            checkpoint.clear()
+            return report
+
+        migrations = []
+        deletions = []
+        for uid, (status, new_uid) in await asyncio.gather(
+                *(check(user.get_uid()) for user in batch)):
+            report.counts[status] += 1
+            if status == MIGRATED:
+                migrations.append((uid, new_uid))
+            elif status == DELETED:
+                deletions.append(uid)
+
+        if migrations or deletions:
+            await run_blocking(apply_changes, migrations, deletions)
+
+        cursor = batch[-1].get_uid()
+        checkpoint.update(cursor=cursor, counts=dict(report.counts))
+        logging.info(LOG_SWEEP_PROGRESS.format(report.checked(), report.describe(), cursor))
+
+    logging.info(LOG_SWEEP_PAUSED.format(cursor))
+    return report
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import corpus
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'benchmarks', 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf8') as f:
+        return f.read()
+
+
+class CorpusRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'constitution.corpus')
+        self.constitution = read_fixture('constitution.html')
+        self.amendments = read_fixture('bill_of_rights.html')
+        corpus.write_corpus(self.path, corpus.build_corpus(self.constitution, self.amendments)[0])
+        corpus.load_corpus(self.path)
+
+    def tearDown(self):
+        corpus.get_corpus().close()
+        corpus._corpus_loaded = False
+        shutil.rmtree(self.directory)
+
+    def test_picks_up_a_corpus_another_worker_wrote(self):
+        old = corpus.get_corpus()
+        changed = self.constitution.replace('Section 1.', 'Section 1 (amended).', 1)
+        corpus.write_corpus(self.path, corpus.build_corpus(changed, self.amendments)[0])
+
+        self.assertTrue(corpus.reload_corpus())
+        self.assertNotEqual(corpus.get_corpus().revision, old.revision)
+        self.assertFalse(corpus.reload_corpus())
+
+    def test_refresh_reuses_a_file_already_at_the_new_revision(self):
+        changed = self.constitution.replace('Section 1.', 'Section 1 (amended).', 1)
+        corpus.write_corpus(self.path, corpus.build_corpus(changed, self.amendments)[0])
+        written = os.stat(self.path).st_mtime_ns
+
+        self.assertTrue(corpus.refresh_corpus(changed, self.amendments))
+        self.assertEqual(os.stat(self.path).st_mtime_ns, written)
+        self.assertEqual(corpus.get_corpus().revision,
+                         corpus.source_revision(changed, self.amendments))
+        self.assertFalse(corpus.refresh_corpus(changed, self.amendments))
+
+    def test_refresh_keeps_the_corpus_when_the_sources_parse_to_nothing(self):
+        old = corpus.get_corpus()
+        error_page = '<html><body>Wikimedia Error: our servers are experiencing a technical ' \
+                     'problem</body></html>'
+        written = os.stat(self.path).st_mtime_ns
+
+        self.assertFalse(corpus.refresh_corpus(error_page, error_page))
+        self.assertFalse(corpus.refresh_corpus(self.constitution, error_page))
+        self.assertIs(corpus.get_corpus(), old)
+        self.assertEqual(len(corpus.get_corpus()), 34)
+        self.assertEqual(os.stat(self.path).st_mtime_ns, written)
+
+    def test_writes_leave_no_temporary_files(self):
+        corpus.write_corpus(self.path, b'data')
+        self.assertEqual(os.listdir(self.directory), ['constitution.corpus'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import asyncio
+import json
+import time
+import unittest
+
+from types import SimpleNamespace
+from send_queue import OutboundQueue
+
+
+async def send(data):
+    await asyncio.sleep(0.001)
+    return SimpleNamespace(status_code=200, content=json.dumps({'ok': True, 'result': {}}))
+
+
+class OutboundQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def test_rate_limited_chats_do_not_hold_shared_slots(self):
+        queue = OutboundQueue(send, rate=1000, bucket_size=1000, max_concurrent=20)
+        # 20 groups past their per-chat burst, each waiting seconds for its next token
+        groups = [queue.enqueue('-{}'.format(100 + i), '{}') for i in range(20) for _ in range(6)]
+        while queue.sent < 20 * 5:
+            await asyncio.sleep(0.01)
+
+        start = time.monotonic()
+        await queue.enqueue('1', '{}')
+        self.assertLess(time.monotonic() - start, 0.5)
+
+        for future in groups:
+            future.cancel()
+        await asyncio.gather(*groups, return_exceptions=True)
+
+    async def test_queues_sharing_a_bucket_share_its_rate(self):
+        sends = OutboundQueue(send, rate=10, bucket_size=10)
+        checks = OutboundQueue(send, bucket=sends.bucket)
+        futures = [queue.enqueue(str(uid), '{}') for uid in range(1, 11) for queue in
+                   (sends, checks)]
+
+        start = time.monotonic()
+        await asyncio.gather(*futures)
+        # 20 requests against 10 tokens refilled at 10/s
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
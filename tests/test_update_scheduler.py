@@ -0,0 +1,39 @@
+import asyncio
+import time
+import unittest
+
+from types import SimpleNamespace
+from update_scheduler import ChatOrderedProcessor
+
+
+def make_update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_message=None)
+
+
+class ChatOrderedProcessorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_backlog_in_one_chat_does_not_block_others(self):
+        processor = ChatOrderedProcessor(4)
+        await processor.initialize()
+        finished = {}
+
+        async def handler(name, seconds):
+            await asyncio.sleep(seconds)
+            finished[name] = time.monotonic()
+
+        start = time.monotonic()
+        # go through PTB's own semaphore, as Application does
+        busy = [asyncio.create_task(processor.process_update(
+            make_update(1), handler('busy{}'.format(i), 0.25))) for i in range(6)]
+        await asyncio.sleep(0)
+        other = asyncio.create_task(processor.process_update(make_update(2), handler('other', 0)))
+        await asyncio.gather(other, *busy)
+
+        self.assertLess(finished['other'] - start, 0.2)
+        # the busy chat's updates still ran one at a time, in order
+        order = sorted(('busy{}'.format(i) for i in range(6)), key=finished.get)
+        self.assertEqual(order, ['busy{}'.format(i) for i in range(6)])
+        self.assertGreaterEqual(finished['busy5'] - start, 6 * 0.25 - 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from user_store import UserStore
+
+
+def make_row(uid, first_name='First'):
+    return (uid, None, first_name, None, 1000.0, None, None, None, 0)
+
+
+class UserStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = UserStore(os.path.join(self.directory, 'users.db'), flush_interval=60,
+                               flush_threshold=10)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_put_hands_the_flush_to_the_flusher(self):
+        flushed = threading.Event()
+        flush = self.store.flush
+
+        def flush_and_signal():
+            flush()
+            flushed.set()
+        self.store.flush = flush_and_signal
+
+        for uid in range(10):
+            self.store.put(make_row(uid))
+        self.assertEqual(self.store.rows_written, 0)  # put returned without writing
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(self.store.rows_written, 10)
+
+    def test_reads_see_rows_while_they_are_being_flushed(self):
+        self.store.put(make_row(1, 'Kept'))
+        self.store.delete(2)
+        self.store.cache.invalidate(1)
+        with self.store._lock:
+            self.store._flushing, self.store._dirty = self.store._dirty, {}
+            self.store._flushing_deleted, self.store._deleted = self.store._deleted, set()
+        self.assertEqual(self.store.get(1)[2], 'Kept')
+        self.assertIsNone(self.store.get(2))
+
+    def test_batch_sees_buffered_changes(self):
+        for uid in (3, 1, 2):
+            self.store.put(make_row(uid))
+        self.store.delete(2)
+        self.assertEqual([row[0] for row in self.store.batch()], [1, 3])
+
+    def test_reads_and_writes_do_not_wait_for_a_flush(self):
+        self.store.put(make_row(1))
+        done = threading.Event()
+
+        def use_store():
+            self.store.put(make_row(2))
+            self.store.get(1)
+            self.store.cache.invalidate(1)
+            self.store.get(1)
+            done.set()
+        with self.store._write_lock:  # as while a flush is writing
+            threading.Thread(target=use_store).start()
+            self.assertTrue(done.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import metrics
+import os
+import time
+import weakref
+
+import httpx
+
+from telegram.request import HTTPXRequest
+
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+MAX_CONNECTIONS = int(os.environ.get('TELEGRAM_MAX_CONNECTIONS', 20))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('TELEGRAM_MAX_KEEPALIVE', 10))
+KEEPALIVE_EXPIRY = 30.0  # seconds
+CONNECT_TIMEOUT = 5.0
+DEFAULT_TIMEOUT = 10.0
+
+JSON_HEADER = {'Content-Type': 'application/json;charset=utf-8'}
+
+SEND_SECONDS = metrics.histogram('constitutionbot_telegram_request_seconds',
+                                 'Time spent on Bot API requests', ('method',))
+
+_limits = httpx.Limits(max_connections=MAX_CONNECTIONS,
+                       max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                       keepalive_expiry=KEEPALIVE_EXPIRY)
+
+# httpx pools are bound to the loop that opened them, so keep one client per loop
+_clients = weakref.WeakKeyDictionary()
+
+
+def configure(max_connections=None, max_keepalive_connections=None):
+    global _limits
+    _limits = httpx.Limits(
+        max_connections=max_connections or _limits.max_connections,
+        max_keepalive_connections=max_keepalive_connections or _limits.max_keepalive_connections,
+        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(limits=_limits, headers=JSON_HEADER,
+                                   timeout=httpx.Timeout(DEFAULT_TIMEOUT, connect=CONNECT_TIMEOUT))
+        _clients[loop] = client
+    return client
+
+
+async def post(url, data, timeout=DEFAULT_TIMEOUT):
+    start = time.perf_counter()
+    try:
+        return await get_client().post(url, content=data, timeout=timeout)
+    finally:
+        SEND_SECONDS.observe(time.perf_counter() - start, url.rsplit('/', 1)[-1])
+
+
+class TimedRequest(HTTPXRequest):
+    # the request object PTB's bot uses, timed into the same histogram as our own sends.
+    # on_error gets the raw description of failed calls, before PTB rewords it into an exception
+    def __init__(self, *args, on_error=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_error = on_error
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, request_data, read_timeout,
+                                                       write_timeout, connect_timeout,
+                                                       pool_timeout)
+            if status >= 300 and self.on_error is not None:
+                try:
+                    self.on_error(str(json.loads(payload).get('description')))
+                except ValueError:
+                    pass
+            return status, payload
+        finally:
+            if api_method != 'getUpdates':  # long polls would only drown out the sends
+                SEND_SECONDS.observe(time.perf_counter() - start, api_method)
+
+
+async def close():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,133 @@
+import asyncio
+import metrics
+import os
+import time
+
+from collections import deque
+from telegram.ext import BaseUpdateProcessor
+
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 16))
+MAX_QUEUED_UPDATES = 100000
+WAIT_SAMPLES = 1000
+
+UPDATES = metrics.counter('constitutionbot_updates_total', 'Updates handled, by command',
+                          ('command',))
+HANDLER_SECONDS = metrics.histogram('constitutionbot_handler_seconds',
+                                    'Time from an update starting to its handlers finishing',
+                                    ('command',))
+
+
+def chat_key(update):
+    # updates sharing a key are handled in arrival order
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    return None
+
+
+def update_command(update, commands=()):
+    # a bounded label for metrics: a known /command, or the kind of update
+    message = getattr(update, 'effective_message', None)
+    if getattr(update, 'inline_query', None) is not None:
+        return 'inline_query'
+    if message is None:
+        return 'other'
+    text = message.text or ''
+    if text.startswith('/'):
+        command = text.split(None, 1)[0][1:].split('@', 1)[0].lower()
+        return '/' + command if command in commands else 'unknown_command'
+    return 'message'
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    # runs different chats' updates in parallel while keeping each chat's updates in order, so
+    # one slow /get doesn't hold up everyone else and main_cmd's reply_to flow stays consistent
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY, commands=(), profiler=None):
+        # PTB takes its own semaphore before do_process_update, which would let a busy chat hold
+        # slots while it waits for its turn; that one only caps queued updates and the real
+        # limit applies once an update is next in line for its chat
+        self.limit = max_concurrent_updates
+        self.commands = {command.lower() for command in commands}
+        self.profiler = profiler  # a profiling.HandlerProfiler, or None to run handlers as is
+        super().__init__(MAX_QUEUED_UPDATES)
+
+        self.queued = 0
+        self.running = 0
+        self.processed = 0
+        self.max_wait = 0.0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._slots = None
+        self._chats = {}  # chat key -> [tail future, updates pending]
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.limit)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        if self._slots is None:
+            await self.initialize()
+        enqueued = time.monotonic()
+        key = chat_key(update)
+        done = asyncio.get_running_loop().create_future()
+
+        previous = None
+        if key is not None:
+            chat = self._chats.get(key)
+            if chat is None:
+                chat = self._chats[key] = [done, 0]
+            else:
+                previous = chat[0]
+                chat[0] = done
+            chat[1] += 1
+
+        self.queued += 1
+        waiting = True
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self._slots:
+                waiting = False
+                self.queued -= 1
+                self._record_wait(time.monotonic() - enqueued)
+                self.running += 1
+                started = time.perf_counter()
+                try:
+                    if self.profiler is None:
+                        await coroutine
+                    else:
+                        await self.profiler.run(update_command(update, self.commands), coroutine,
+                                                update)
+                finally:
+                    self.running -= 1
+                    self.processed += 1
+                    command = update_command(update, self.commands)
+                    UPDATES.inc(command)
+                    HANDLER_SECONDS.observe(time.perf_counter() - started, command)
+        finally:
+            if waiting:
+                self.queued -= 1
+                coroutine.close()
+            done.set_result(None)
+            if key is not None:
+                chat = self._chats[key]
+                chat[1] -= 1
+                if chat[1] == 0:
+                    del self._chats[key]
+
+    def _record_wait(self, wait):
+        self._waits.append(wait)
+        self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        waits = sorted(self._waits)
+        depths = [chat[1] for chat in self._chats.values()]
+        return {'queued': self.queued, 'running': self.running, 'processed': self.processed,
+                'chats': len(depths), 'max_chat_depth': max(depths, default=0),
+                'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+                'wait_p99': waits[int(len(waits) * 0.99) - 1] if waits else 0.0,
+                'wait_max': self.max_wait}
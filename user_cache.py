@@ -0,0 +1,63 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))  # seconds
+
+
+class UserCache:
+    def __init__(self, capacity=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._rows = OrderedDict()  # uid -> (stored_at, row), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, uid):
+        with self._lock:
+            entry = self._rows.get(uid)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._rows[uid]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._rows.move_to_end(uid)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, uid, row):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._rows[uid] = (time.monotonic(), row)
+            self._rows.move_to_end(uid)
+            while len(self._rows) > self.capacity:
+                self._rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, uid):
+        with self._lock:
+            self._rows.pop(uid, None)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'size': len(self._rows), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate(), 'evictions': self.evictions,
+                'expirations': self.expirations}
@@ -0,0 +1,199 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+
+from user_cache import UserCache
+
+USER_DB_PATH = os.environ.get('USER_DB_PATH', 'users.db')
+USER_FLUSH_INTERVAL = float(os.environ.get('USER_FLUSH_INTERVAL', 5))  # seconds
+USER_FLUSH_THRESHOLD = 500  # dirty users that trigger an early flush
+
+COLUMNS = ('uid', 'username', 'first_name', 'last_name', 'created', 'last_received', 'last_sent',
+           'reply_to', 'promo')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    uid INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    created REAL NOT NULL,
+    last_received REAL,
+    last_sent REAL,
+    reply_to TEXT,
+    promo INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_promo_created ON users (promo, created);
+'''
+
+UPSERT = 'INSERT OR REPLACE INTO users ({}) VALUES ({})'.format(
+    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+SELECT = 'SELECT {} FROM users'.format(', '.join(COLUMNS))
+
+
+class UserStore:
+    def __init__(self, path=USER_DB_PATH, flush_interval=USER_FLUSH_INTERVAL,
+                 flush_threshold=USER_FLUSH_THRESHOLD, cache=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.flushes = 0
+        self.rows_written = 0
+        self.cache = cache if cache is not None else UserCache()
+
+        # reads share one connection; flushes write through their own, so with WAL a read
+        # never waits for a flush's transaction
+        self._conn = self._connect()
+        self._conn.executescript(SCHEMA)
+        self._writer = self._connect()
+
+        # write-behind buffer: the latest row per uid plus pending deletions, and the ones a
+        # flush is writing right now
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._dirty = {}
+        self._deleted = set()
+        self._flushing = {}
+        self._flushing_deleted = set()
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='user-store-flush',
+                                         daemon=True)
+        self._flusher.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _flush_periodically(self):
+        # every flush_interval, or as soon as put has buffered flush_threshold users
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error('Error flushing user store:\n' + str(e))
+
+    def get(self, uid):
+        with self._lock:
+            if uid in self._deleted:
+                return None
+            row = self.cache.get(uid)
+            if row is not None:
+                return row
+            row = self._dirty.get(uid)
+            if row is None:
+                if uid in self._flushing_deleted:
+                    return None
+                row = self._flushing.get(uid)
+            if row is None:
+                row = self._conn.execute(SELECT + ' WHERE uid = ?', (uid,)).fetchone()
+            if row is not None:
+                self.cache.set(uid, row)
+            return row
+
+    def put(self, row):
+        with self._lock:
+            self._deleted.discard(row[0])
+            self._dirty[row[0]] = row
+            self.cache.set(row[0], row)
+            if len(self._dirty) >= self.flush_threshold:
+                self._wake.set()  # handlers run on the event loop, so the flusher writes
+
+    def delete(self, uid):
+        with self._lock:
+            self._dirty.pop(uid, None)
+            self._deleted.add(uid)
+            self.cache.invalidate(uid)
+
+    def flush(self):
+        # the buffer is swapped out under the lock and written outside it, so gets and puts
+        # don't wait on SQLite; one flush writes at a time
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty and not self._deleted:
+                    return
+                self._flushing, self._dirty = self._dirty, {}
+                self._flushing_deleted, self._deleted = self._deleted, set()
+            rows = list(self._flushing.values())
+            deleted = [(uid,) for uid in self._flushing_deleted]
+            try:
+                self._writer.execute('BEGIN')
+                try:
+                    self._writer.executemany(UPSERT, rows)
+                    self._writer.executemany('DELETE FROM users WHERE uid = ?', deleted)
+                    self._writer.execute('COMMIT')
+                except sqlite3.Error:
+                    self._writer.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error:
+                with self._lock:
+                    # keep them for the next flush, unless they changed meanwhile
+                    for uid, row in self._flushing.items():
+                        if uid not in self._dirty and uid not in self._deleted:
+                            self._dirty[uid] = row
+                    for uid in self._flushing_deleted:
+                        if uid not in self._dirty:
+                            self._deleted.add(uid)
+                    self._flushing, self._flushing_deleted = {}, set()
+                raise
+            with self._lock:
+                self._flushing, self._flushing_deleted = {}, set()
+                self.flushes += 1
+                self.rows_written += len(rows) + len(deleted)
+
+    def batch(self, after_uid=None, batch_size=500, promo=None, created_before=None):
+        query = SELECT + ' WHERE uid > ?'
+        params = [after_uid if after_uid is not None else -2 ** 63]
+        if promo is not None:
+            query += ' AND promo = ?'
+            params.append(int(promo))
+        if created_before is not None:
+            query += ' AND created < ?'
+            params.append(created_before)
+        query += ' ORDER BY uid LIMIT ?'
+        params.append(batch_size)
+
+        # bulk scans bypass the cache so a sweep doesn't evict the active chats. They run on
+        # worker threads: flushed first so they see every change, then read without the lock
+        self.flush()
+        return self._conn.execute(query, params).fetchall()
+
+    def stats(self):
+        with self._lock:
+            return {'dirty': len(self._dirty) + len(self._deleted) + len(self._flushing) +
+                    len(self._flushing_deleted), 'flushes': self.flushes,
+                    'rows_written': self.rows_written, 'cache': self.cache.stats()}
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+        self._writer.close()
+        self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = UserStore()
+            atexit.register(_store.close)
+    return _store
+
+
+def close_store():
+    if _store is not None:
+        _store.close()
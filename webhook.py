@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+import os
+
+from http import HTTPStatus
+from telegram import Update
+
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY = 1024 * 1024
+
+
+class WebhookServer:
+    def __init__(self, application, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+
+        self.received = 0
+        self.rejected = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info('Webhook listening on {}:{}{}'.format(self.listen, self.port, self.path))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                    break
+                body = await reader.readexactly(length)
+
+                self._respond(writer, self._accept(method, target, headers, body))
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _accept(self, method, target, headers, body):
+        if method != 'POST' or target.split('?', 1)[0] != self.path:
+            return HTTPStatus.NOT_FOUND
+        if self.secret is not None and headers.get(SECRET_HEADER) != self.secret:
+            self.rejected += 1
+            return HTTPStatus.FORBIDDEN
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except ValueError:
+            self.rejected += 1
+            return HTTPStatus.BAD_REQUEST
+
+        # acknowledge straight away; Telegram holds back the chat's next update until we answer.
+        # The application's update processor takes care of concurrency and per-chat order
+        self.received += 1
+        self.application.update_queue.put_nowait(update)
+        return HTTPStatus.OK
+
+    @staticmethod
+    def _respond(writer, status):
+        writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\n\r\n'.format(
+            status.value, status.phrase).encode('latin-1'))
+
+    def stats(self):
+        return {'received': self.received, 'rejected': self.rejected}
+
+
+async def run_webhook(application, server, webhook_url=None, on_shutdown=None, on_started=None):
+    async with application:
+        await application.start()
+        await server.start()
+        if webhook_url:
+            await application.bot.set_webhook(webhook_url, secret_token=server.secret,
+                                              allowed_updates=Update.ALL_TYPES)
+        if on_started is not None:
+            on_started()
+        try:
+            await asyncio.Event().wait()  # until interrupted
+        finally:
+            await server.stop()
+            await application.stop()
+            if on_shutdown is not None:
+                await on_shutdown(application)